@@ -0,0 +1,119 @@
+"""
+Benchmark of the peak memory (resident set size) and of the
+time needed to compare the output of two versions of class,
+with the default comparison and with the memory-bounded one
+(run --low-memory, optionally with --float32). Synthetic
+cl and pk files are generated with rows lines each (default
+1000000), the pk files of the two versions on different grids.
+
+Usage: python benchmark_memory.py [rows]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+import subprocess
+import numpy as np
+import functions as fs
+
+
+#Modes compared, with the dtype of the streaming comparison
+MODES = [
+    ('default', None),
+    ('low-memory', 'float64'),
+    ('low-memory+float32', 'float32')
+]
+
+
+def write_output(folder, rows):
+    """
+    Write the synthetic output files of the two versions
+    of class in folder. The cl files share the grid, the
+    pk files of the second version have a denser one.
+    """
+
+    l = np.arange(2., rows + 2.)
+    for (v, eps) in [('v1', 0.), ('v2', 1.e-3)]:
+        cl = np.c_[l, 1.e3/l*(1. + eps*np.sin(l/100.)), 1.e1/l]
+        np.savetxt(folder + 'bench_' + v + '_cl.dat', cl,
+            header='  1:l  2:TT  3:EE')
+    for (v, n, eps) in [('v1', rows, 0.), ('v2', rows + rows//3, 1.e-3)]:
+        k = np.logspace(-5., 1., n)
+        pk = np.c_[k, 1.e4*k/(1. + (k/0.02)**3)*(1. + eps*np.cos(np.log(k)))]
+        np.savetxt(folder + 'bench_' + v + '_pk.dat', pk,
+            header='  1:k (h/Mpc)   2:P (Mpc/h)^3')
+
+    return
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process, in MB
+    (ru_maxrss is in kB on Linux, in bytes on OS X).
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/1024.**2
+    return peak/1024.
+
+
+def child(mode, folder):
+    """
+    Compare the files in folder with the given mode and
+    print the peak memory before and after, and the time.
+    """
+
+    params = {'var': {}, 'metrics': {}}
+    folders = {'tmp': folder, 'f_prefix': 'bench_'}
+    dtype = dict(MODES)[mode]
+    before = peak_rss()
+    start = time.time()
+    if dtype is None:
+        output_data, identical = fs.read_output_pair(folders)
+        output_diff = fs.get_output_diff_struct(params, output_data)
+        fs.compare_output(params, output_data, output_diff)
+    else:
+        diff, identical = fs.stream_output_pair(params, folders, dtype=dtype)
+    print before, peak_rss(), time.time() - start
+
+    return
+
+
+def main(rows):
+    """
+    Generate the files and run each mode in a separate
+    process, so that the peak memory of one mode does not
+    affect the others. Print the results.
+    """
+
+    folder = tempfile.mkdtemp() + '/'
+    try:
+        print '----> Writing ' + str(rows) + ' rows per file'
+        sys.stdout.flush()
+        write_output(folder, rows)
+        size = sum(os.path.getsize(folder + f) for f in os.listdir(folder))
+        print '----> Total size of the files: %.1f MB' % (size/1024.**2)
+        print '%-20s %14s %14s %10s' % ('mode', 'peak RSS (MB)',
+            'increase (MB)', 'time (s)')
+        for (mode, dtype) in MODES:
+            out = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--child', mode, folder])
+            before, after, t = [float(x) for x in out.split()[-3:]]
+            print '%-20s %14.1f %14.1f %10.2f' % (mode, after, after - before,
+                t)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(folder)
+
+    return
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,5 +1,6 @@
 import os
 import sys
+import random
 import functions as fs
 import global_variables as gv
 
@@ -28,18 +29,40 @@ def run(args):
     #for them (keys: 'common', 'v1', 'v2')
     params = fs.read_input_parameters(args)
 
+    #The memory-bounded comparison does not keep the output in memory
+    if args.low_memory and (args.against_bank or args.archive):
+        raise IOError('--------> --low-memory is not available with '
+            '--against-bank and --archive!')
+    if args.float32 and not args.low_memory:
+        raise IOError('--------> --float32 is available only with '
+            '--low-memory!')
+    dtype = 'float32' if args.float32 else 'float64'
+
     #Get output path and name
     params = fs.get_output_path_and_name(params)
 
     #Create folder structure
     params, folders = fs.create_folders(args, params)
 
+    #Read the bank, if any. The output of class_v1 is taken from it
+    if args.against_bank:
+        bank = fs.read_bank(args.against_bank)
+        args.N = len(bank['samples'])
+        versions = ['v2']
+    else:
+        versions = ['v1', 'v2']
+
     #Generate ref output
     if args.ref:
         #Prepare params for ref models
         params = fs.prepare_ref_params(params)
 
-        for v in ['ref_v1', 'ref_v2']:
+        if args.against_bank:
+            if not bank['ref']:
+                raise IOError('--------> The bank in ' + args.against_bank
+                    + ' has no reference outputs (generate it with --ref)!')
+            output_data['ref_v1'] = bank['ref']
+        for v in ['ref_' + x for x in versions]:
             #Group parameters together for each version of class
             params[v] = fs.group_parameters(params[v])
 
@@ -58,6 +81,38 @@ def run(args):
     #Separate fixed params from the varying ones
     params = fs.separate_fix_from_varying(params)
 
+    #Check that the bank has been generated with the same parameters
+    if args.against_bank:
+        fs.check_bank_fingerprint(bank, params)
+
+    #Estimate the cost of the sweep from the runtimes of the previous
+    #runs. With a budget, run as many samples as it allows
+    model = fs.fit_runtime_model(params, fs.read_runtime_log(folders))
+    cost = fs.sample_cost(params, model, versions)
+    if args.budget and not args.against_bank:
+        if cost is None:
+            raise IOError('--------> Not enough runs in the runtime log '
+                'to estimate the cost of a sample!')
+        args.N = fs.budget_samples(args.budget, cost, 1)
+        if args.N < 1:
+            raise IOError('--------> The budget is too small for one sample!')
+        print '----> Budget of %g node-hours: N = %d' % (args.budget, args.N)
+    if cost is not None:
+        fs.print_estimate(args.N, cost, 1)
+
+    #Initialize the archive
+    if args.archive:
+        archive_batch = {}
+        archive_shard = 1
+        if args.ref:
+            fs.write_archive_ref(output_data, folders)
+
+    #Initialize the telemetry
+    telemetry = fs.init_telemetry(args.N)
+    fs.write_telemetry(telemetry, folders, args.metrics_file)
+    if args.metrics_port:
+        fs.serve_telemetry(telemetry, args.metrics_port)
+
     #Start loop
     for step in range(1, args.N+1):
 
@@ -65,59 +120,112 @@ def run(args):
         output_data['v1'] = {}
         output_data['v2'] = {}
 
+        #Against the bank the sample is fixed, so only class_v2 is run
+        #and the sample is skipped if it does not generate output
+        if args.against_bank:
+            params = fs.assign_bank_sample(params, bank, step-1)
+            runtimes = {'v2': fs.run_version(params, folders, 'v2')}
+            has_output = fs.has_output(folders, 'v2', 1)
+            fs.print_messages(has_output)
+            fs.record_attempt(telemetry, has_output, runtimes)
+            fs.clean_ini(step, folders, has_output, versions=versions)
+            if has_output is 2:
+                output_data['v1'] = fs.read_bank_output(bank, step-1)
+                output_data['v2'] = fs.read_output(folders, 'v2')
+                identical = fs.identical_files(output_data)
+
         #Only if has_output is 2 (both codes generated output)
         #exit the loop. Otherwise repeat the loop with new params.
-        has_output = 0
-        while has_output is not 2:
-
-            #Generate random numbers for the varying parameters
-            params = fs.generate_random_params(params)
-
-            #Initialize has_output to 0.
+        else:
             has_output = 0
-            for v in ['v1', 'v2']:
+            while has_output is not 2:
 
-                #Group parameters together for each version of class
-                params[v] = fs.group_parameters(params[v])
+                #Generate random numbers for the varying parameters
+                params = fs.generate_random_params(params)
 
-                #Create ini files
-                folders = fs.create_ini_file(params[v], folders, v)
+                #Initialize has_output to 0.
+                has_output = 0
+                runtimes = {}
+                for v in ['v1', 'v2']:
 
-                #Run class
-                fs.run_class(folders, v)
+                    #Create ini files and run class
+                    runtimes[v] = fs.run_version(params, folders, v)
 
-                #Check if run_class generated output
-                has_output = fs.has_output(folders, v, has_output)
+                    #Check if run_class generated output
+                    has_output = fs.has_output(folders, v, has_output)
 
-            #Print messages and store ini files depending on has_output
-            fs.print_messages(has_output)
+                #Print messages and store ini files depending on has_output
+                fs.print_messages(has_output)
+                fs.record_attempt(telemetry, has_output, runtimes)
+                fs.write_telemetry(telemetry, folders, args.metrics_file)
 
-            #Clean ini files. If only one output has been generated,
-            #store the ini files in ini_to_check/.
-            fs.clean_ini(step, folders, has_output)
+                #Clean ini files. If only one output has been generated,
+                #store the ini files in ini_to_check/.
+                fs.clean_ini(step, folders, has_output)
 
-        #Read output and return a dictionary with data for each file
-        for v in ['v1', 'v2']:
-            output_data[v] = fs.read_output(folders, v)
+                #Read output and return a dictionary with data for each
+                #file. Bit-identical files are parsed only once. With
+                #low memory, compare the files while reading them
+                if has_output is 2 and args.low_memory:
+                    diff, identical = fs.stream_output_pair(params, folders,
+                        output_data if args.ref else None, dtype)
+                elif has_output is 2:
+                    data, identical = fs.read_output_pair(folders)
+                    output_data.update(data)
 
-        #Initialize structure of output_diff
-        if not output_diff:
-            output_diff = fs.get_output_diff_struct(params, output_data)
-        #Compare output
-        fs.compare_output(params, output_data, output_diff)
+        #Skip the samples of the bank without output from class_v2
+        if has_output is not 2:
+            fs.record_sample(telemetry, step, output_diff)
+            fs.write_telemetry(telemetry, folders, args.metrics_file)
+            print 'Skipped run ' + str(step) + ' of ' + str(args.N)
+            sys.stdout.flush()
+            continue
+
+        if args.low_memory:
+            fs.append_diff(params, output_diff, diff)
+        else:
+            #Initialize structure of output_diff
+            if not output_diff:
+                output_diff = fs.get_output_diff_struct(params, output_data)
+            #Compare output
+            fs.compare_output(params, output_data, output_diff)
         #Compare reference and store in output_diff_ref
         if args.ref and not output_diff_ref:
-            output_diff_ref = fs.get_output_diff_struct(params, output_data)
-            fs.compare_output(params, output_data, output_diff_ref, mode='ref')
+            data = dict(output_data)
+            if args.low_memory:
+                data['v1'] = output_data['ref_v1']
+                data['v2'] = output_data['ref_v2']
+            output_diff_ref = fs.get_output_diff_struct(params, data)
+            fs.compare_output(params, data, output_diff_ref, mode='ref')
+
+        #Archive the output, writing a shard for each batch
+        if args.archive:
+            fs.archive_sample(archive_batch, step, params, output_data)
+            if len(set(k.split('.')[0] for k in archive_batch.keys())) \
+                >= args.archive_batch:
+                fs.write_archive_shard(archive_batch, folders, archive_shard)
+                archive_shard += 1
 
         #Remove tmp output files
-        for file in os.listdir(folders['tmp']):
-            os.remove(folders['tmp'] + file)
+        fs.clean_workspace(folders['tmp'])
+
+        #Update the telemetry
+        fs.record_sample(telemetry, step, output_diff, identical)
+        fs.write_telemetry(telemetry, folders, args.metrics_file)
 
         #Print to screen the end of this iteration
         print 'Completed run ' + str(step) + ' of ' + str(args.N)
         sys.stdout.flush()
 
+    #Write the last shard of the archive
+    if args.archive:
+        if archive_batch:
+            fs.write_archive_shard(archive_batch, folders, archive_shard)
+        print 'Saved archive in ' + os.path.relpath(folders['archive'])
+
+    #Number of samples with bit-identical output for each file
+    fs.print_identical(telemetry)
+
     #Write output
     output_path = fs.write_output_file(output_diff, folders)
     print 'Saved output table in ' + os.path.relpath(output_path)
@@ -143,15 +251,424 @@ def run(args):
         sys.stdout.flush()
 
     #Clean output files and folders
+    fs.release_workspace(folders['tmp'])
     try:
+        os.rmdir(folders['ini_to_check'])
+    except:
+        pass
+
+
+    return
+
+
+
+def update(args):
+    return
+
+
+def bank(args):
+    """
+    Generate a bank of outputs of class_v1. The main steps are:
+      (i) Read the input parameters and seed the random generator
+     (ii) Generate random values for the varying parameters, until
+          class_v1 generates output
+    (iii) Read the output of class_v1
+     (iv) Store the samples, the outputs and the fingerprints of the
+          input parameters in the bank folder
+
+    Loop over points (ii)-(iii) to sample different models.
+    The bank can then be used with "run --against-bank" to run
+    only class_v2 on the same samples.
+    """
+
+    #Initialize main dictionaries
+    params = {}
+    folders = {}
+    output_bank = {}
+
+    #Read input parameters and output dictionaries
+    #for them (keys: 'common', 'v1', 'v2')
+    params = fs.read_input_parameters(args)
+
+    #Get output path and name
+    params = fs.get_output_path_and_name(params)
+
+    #Create folder structure
+    params, folders = fs.create_folders(args, params)
+
+    #Fixed seed, so that the samples are reproducible
+    random.seed(args.seed)
+
+    #Generate ref output
+    output_bank['ref'] = None
+    if args.ref:
+        params = fs.prepare_ref_params(params)
+        params['ref_v1'] = fs.group_parameters(params['ref_v1'])
+        folders = fs.create_ini_file(params['ref_v1'], folders, 'ref_v1')
+        fs.run_class(folders, 'ref_v1')
+        try:
+            output_bank['ref'] = fs.read_output(folders, 'ref_v1')
+        except:
+            raise IOError('--------> No ref output found!')
         os.remove(folders['ini_ref_v1'])
-        os.remove(folders['ini_ref_v2'])
+        params.pop('ref_v2', None)
+
+    #Separate fixed params from the varying ones
+    params = fs.separate_fix_from_varying(params)
+
+    #Fingerprints of the parameters of class_v1
+    output_bank['fingerprint'] = fs.bank_fingerprint(params)
+    output_bank['fingerprint']['seed'] = args.seed
+    output_bank['fingerprint']['N'] = args.N
+    output_bank['fingerprint']['root_class_v1'] = folders['v1']
+    output_bank['var'] = sorted(params['var'].keys())
+    output_bank['samples'] = []
+    output_bank['output'] = []
+
+    #Start loop
+    for step in range(1, args.N+1):
+
+        #Generate random numbers for the varying parameters
+        #until class_v1 generates output
+        has_output = 0
+        while has_output is not 1:
+            params = fs.generate_random_params(params)
+            fs.run_version(params, folders, 'v1')
+            has_output = fs.has_output(folders, 'v1', 0)
+            os.remove(folders['ini_v1'])
+            if has_output is not 1:
+                print '--------> class_v1 failed to run'
+                sys.stdout.flush()
+
+        #Store sample and output
+        output_bank['samples'].append(
+            [fs.get_sample(params)[k] for k in output_bank['var']])
+        output_bank['output'].append(fs.read_output(folders, 'v1'))
+
+        #Remove tmp output files
+        fs.clean_workspace(folders['tmp'])
+
+        #Print to screen the end of this iteration
+        print 'Completed sample ' + str(step) + ' of ' + str(args.N)
+        sys.stdout.flush()
+
+    #Write bank
+    path = fs.write_bank(args.bank_dir, output_bank)
+    print 'Saved bank in ' + os.path.relpath(path)
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
+    try:
+        os.rmdir(folders['ini_to_check'])
     except:
         pass
+
+
+    return
+
+
+def ladder(args):
+    """
+    Precision ladder. The main steps are:
+      (i) Read the input parameters, the baseline precision settings
+          (--params-v1, run with class-v1) and the ladder of candidate
+          precision settings (run with class-v2)
+     (ii) Generate random values for the varying parameters, until
+          the baseline generates output
+    (iii) Run each candidate on the same sample, storing its runtime
+     (iv) Read the outputs and calculate the relative diffs of each
+          candidate with respect to the baseline
+      (v) Output a table with the max diffs and the runtime of each
+          candidate, the accuracy-versus-cost frontier and the fastest
+          candidate within tolerance for each variable
+
+    Loop over points (ii)-(iv) to build the shared sample set
+    """
+
+    #Initialize main dictionaries
+    params = {}
+    folders = {}
+    output_data = {}
+    output_diff = {}
+    runtimes = {}
+    failures = {}
+
+    #Read input parameters and output dictionaries
+    #for them (keys: 'common', 'v1', 'v2', 'v2_1', 'v2_2', ...)
+    params = fs.read_input_parameters(args)
+    versions = fs.ladder_versions(params)
+
+    #Get output path and name
+    params = fs.get_output_path_and_name(params)
+
+    #Create folder structure
+    params, folders = fs.create_folders(args, params)
+
+    #Separate fixed params from the varying ones
+    params = fs.separate_fix_from_varying(params)
+
+    #Initialize runtimes and failures
+    runtimes['v1'] = []
+    for v in versions:
+        runtimes[v] = []
+        failures[v] = 0
+
+    #Start loop
+    for step in range(1, args.N+1):
+
+        #Generate random numbers for the varying parameters
+        #until the baseline generates output
+        has_output = 0
+        while has_output is not 1:
+            params = fs.generate_random_params(params)
+            runtime = fs.run_version(params, folders, 'v1')
+            has_output = fs.has_output(folders, 'v1', 0)
+            os.remove(folders['ini_v1'])
+            if has_output is not 1:
+                print '--------> Baseline failed to run'
+                sys.stdout.flush()
+        runtimes['v1'].append(runtime)
+        output_data['v1'] = fs.read_output(folders, 'v1')
+
+        #Run each candidate on the same sample
+        for v in versions:
+            runtime = fs.run_version(params, folders, v)
+            os.remove(folders['ini_' + v])
+            runtimes[v].append(runtime)
+            if fs.has_output(folders, v, 0) is not 1:
+                print '--------> Candidate ' + v.split('_')[-1] + ' failed'
+                sys.stdout.flush()
+                failures[v] += 1
+                continue
+            data = {'v1': output_data['v1'], 'v2': fs.read_output(folders, v)}
+            #Initialize structure of output_diff
+            if v not in output_diff:
+                output_diff[v] = fs.get_output_diff_struct(params, data)
+            #Compare output
+            fs.compare_output(params, data, output_diff[v])
+
+        #Remove tmp output files
+        fs.clean_workspace(folders['tmp'])
+
+        #Print to screen the end of this iteration
+        print 'Completed sample ' + str(step) + ' of ' + str(args.N)
+        sys.stdout.flush()
+
+    #Candidates that never generated output
+    for v in versions:
+        if v not in output_diff:
+            output_diff[v] = fs.get_output_diff_struct(params,
+                {'v1': output_data['v1']})
+
+    #Write output
+    summary = fs.ladder_summary(output_diff, runtimes, failures, args.tol)
+    fname, fsummary = fs.write_ladder_file(summary, args.ladder, folders,
+        args.tol)
+    print 'Saved ladder table in ' + os.path.relpath(fname)
+    print 'Saved ladder summary in ' + os.path.relpath(fsummary)
+    for v in sorted(summary['missing'].keys()):
+        for k in sorted(summary['missing'][v].keys()):
+            print '--------> ' + k + '.dat missing in ' \
+                + str(summary['missing'][v][k]) + ' samples of candidate ' \
+                + args.ladder[int(v.split('_')[-1])-1]
+    for var in summary['tol_vars']:
+        fastest = summary['fastest'][var]
+        if fastest:
+            fastest = args.ladder[int(fastest.split('_')[-1])-1]
+        print '----> ' + var + ': fastest within tolerance = ' + str(fastest)
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
     try:
-        os.rmdir(folders['tmp'])
+        os.rmdir(folders['ini_to_check'])
     except:
         pass
+
+
+    return
+
+
+def coordinator(args):
+    """
+    Coordinator of a distributed run. The main steps are:
+      (i) Read the input parameters and create the job queue
+     (ii) Generate random values for the varying parameters and put
+          them in the queue, one job per sample
+    (iii) Optional: start local workers
+     (iv) Collect the diffs posted by the workers ("compare.py worker").
+          For each failed job put a new sample in the queue, and put back
+          in the queue the jobs of dead workers
+      (v) Output a table with the relative diffs for each model
+     (vi) Optional: output plots with relative diffs for each variable
+
+    Loop over point (iv) until N samples have been successful
+    """
+
+    import time
+    import subprocess
+
+    #Initialize main dictionaries
+    params = {}
+    folders = {}
+    output_diff = {}
+    output_diff_ref = {}
+
+    #Read input parameters and create the folder structure
+    params = fs.read_input_parameters(args)
+    params = fs.get_output_path_and_name(params)
+    params, folders = fs.create_folders(args, params)
+    params = fs.separate_fix_from_varying(params)
+
+    #Create the queue. The workers read the input files
+    #from the same folder as the coordinator
+    config = {
+        'cwd': os.path.abspath('.'),
+        'input_file': args.input_file,
+        'params_v1': args.params_v1,
+        'params_v2': args.params_v2,
+        'ref': args.ref
+    }
+    if args.queue_dir:
+        queue = args.queue_dir
+    else:
+        queue = folders['main'] + folders['f_prefix'] + 'queue/'
+    queue = fs.init_queue(queue, config)
+
+    #Estimate the cost of the sweep from the runtimes of the previous
+    #runs. With a budget, run as many samples as it allows
+    cores = args.cores or max(args.local_workers, 1)
+    model = fs.fit_runtime_model(params, fs.read_runtime_log(folders))
+    cost = fs.sample_cost(params, model, ['v1', 'v2'])
+    if args.budget:
+        if cost is None:
+            raise IOError('--------> Not enough runs in the runtime log '
+                'to estimate the cost of a sample!')
+        args.N = fs.budget_samples(args.budget, cost, cores)
+        if args.N < 1:
+            raise IOError('--------> The budget is too small for one sample!')
+        print '----> Budget of %g node-hours: N = %d' % (args.budget, args.N)
+    if cost is not None:
+        fs.print_estimate(args.N, cost, cores)
+
+    #Put the samples in the queue. With a runtime model, the longest
+    #jobs are claimed first, so that they do not run at the end alone
+    samples = []
+    for n in range(args.N):
+        params = fs.generate_random_params(params)
+        samples.append(fs.get_sample(params))
+    runtimes = fs.predict_runtime(params, model, samples, ['v1', 'v2'])
+    if runtimes is None:
+        runtimes = [0.]*len(samples)
+    next_id = 1
+    for (sample, runtime) in zip(samples, runtimes):
+        fs.post_job(queue, next_id, sample, runtime)
+        next_id += 1
+    print 'Queue ready in ' + os.path.relpath(queue)
+    sys.stdout.flush()
+
+    #Jobs of live workers would be put back in the queue
+    if args.timeout <= gv.QUEUE_HEARTBEAT:
+        print '--------> Warning: timeout shorter than the heartbeat of ' \
+            'the workers (' + str(gv.QUEUE_HEARTBEAT) + ' s)'
+
+    #Start local workers
+    workers = []
+    for n in range(args.local_workers):
+        workers.append(subprocess.Popen([sys.executable,
+            os.path.abspath(__file__), 'worker', queue]))
+
+    #Initialize the telemetry
+    telemetry = fs.init_telemetry(args.N)
+    fs.write_telemetry(telemetry, folders, args.metrics_file)
+
+    #Collect the results
+    processed = set()
+    step = 0
+    while step < args.N:
+        for result in fs.collect_results(queue):
+            #Skip results of jobs run twice
+            if result['id'] in processed:
+                continue
+            processed.add(result['id'])
+            fs.record_attempt(telemetry, result['has_output'],
+                result['runtimes'])
+            if result['has_output'] == 2 and step < args.N:
+                step += 1
+                fs.merge_output_diff(output_diff,
+                    fs.result_to_output_diff(result))
+                if 'ref' in result and not output_diff_ref:
+                    result['diff'] = result['ref']
+                    output_diff_ref = fs.result_to_output_diff(result)
+                    fs.write_output_file(output_diff_ref, folders, mode='ref')
+                fs.record_sample(telemetry, step, output_diff,
+                    result['identical'])
+                #Write the table at each sample, so that the
+                #completed samples are not lost if the run stops
+                fs.write_output_file(output_diff, folders)
+                print 'Completed run ' + str(step) + ' of ' + str(args.N) \
+                    + ' (job ' + str(result['id']) + ')'
+            elif result['has_output'] != 2:
+                #Replace the failed job with a new sample
+                fs.print_messages(result['has_output'])
+                params = fs.generate_random_params(params)
+                sample = fs.get_sample(params)
+                runtime = fs.predict_runtime(params, model, [sample],
+                    ['v1', 'v2'])
+                fs.post_job(queue, next_id, sample,
+                    runtime[0] if runtime is not None else 0.)
+                next_id += 1
+            sys.stdout.flush()
+
+        #Put back in the queue the jobs of dead workers
+        count = fs.requeue_stale_jobs(queue, args.timeout)
+        if count > 0:
+            print '--------> Put back ' + str(count) + ' jobs in the queue'
+            sys.stdout.flush()
+
+        #Stop if all the local workers died
+        if workers and all(w.poll() is not None for w in workers) \
+            and step < args.N:
+            raise IOError('--------> All the local workers died!')
+
+        fs.write_telemetry(telemetry, folders, args.metrics_file)
+        if step < args.N:
+            time.sleep(gv.QUEUE_POLL)
+
+    #Stop the workers
+    for fname in os.listdir(queue + 'pending/'):
+        os.remove(queue + 'pending/' + fname)
+    open(queue + 'stop', 'w').close()
+    for w in workers:
+        w.wait()
+
+    #Number of samples with bit-identical output for each file
+    fs.print_identical(telemetry)
+
+    #Write output
+    output_path = fs.write_output_file(output_diff, folders)
+    print 'Saved output table in ' + os.path.relpath(output_path)
+    #Write output ref
+    if output_diff_ref:
+        output_path = fs.write_output_file(output_diff_ref, folders, mode='ref')
+        print 'Saved output ref table in ' + os.path.relpath(output_path)
+
+    #If requested, generate plots
+    if args.want_plots:
+        fname = folders['main'] + folders['f_prefix'] + 'output.dat'
+        data_plots = fs.read_output_table(fname)
+        fname = folders['main'] + folders['f_prefix'] + 'ref_output.dat'
+        try:
+            data_plots_ref = fs.read_output_table(fname)
+        except:
+            data_plots_ref = None
+        fs.generate_plots(data_plots, data_plots_ref, folders['plots'])
+        print 'Saved figures in ' + os.path.relpath(folders['plots'])
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
     try:
         os.rmdir(folders['ini_to_check'])
     except:
@@ -161,8 +678,548 @@ def run(args):
     return
 
 
+def worker(args):
+    """
+    Worker of a distributed run. The main steps are:
+      (i) Read the configuration of the queue and the input parameters
+     (ii) Optional: run the reference models
+    (iii) Claim a job from the queue
+     (iv) Run the two versions of class on the sample of the job
+      (v) Read the outputs, calculate the relative diffs and post
+          them back to the coordinator
+
+    Loop over points (iii)-(v) until the coordinator stops the queue
+    """
+
+    import json
+    import time
+    import socket
+    import argparse
+
+    #Read the configuration of the queue and move to the
+    #folder of the coordinator
+    queue = fs.folder_exists_or(args.queue_dir, mod='error')
+    with open(queue + 'config.json', 'r') as f:
+        config = json.load(f)
+    os.chdir(config['cwd'])
+    worker_id = socket.gethostname() + '_' + str(os.getpid())
+
+    #Initialize main dictionaries
+    params = {}
+    folders = {}
+    output_data = {}
+
+    #Read input parameters and create the folder structure
+    wargs = argparse.Namespace(input_file=config['input_file'],
+        params_v1=config['params_v1'], params_v2=config['params_v2'],
+        ref=config['ref'], want_plots=False)
+    params = fs.read_input_parameters(wargs)
+    params = fs.get_output_path_and_name(params)
+    params, folders = fs.create_folders(wargs, params, copy_inputs=False)
+
+    #Generate ref output
+    if wargs.ref:
+        params = fs.prepare_ref_params(params)
+        for v in ['ref_v1', 'ref_v2']:
+            fs.run_version(params, folders, v)
+            try:
+                output_data[v] = fs.read_output(folders, v)
+            except:
+                raise IOError('--------> No ref output found!')
+
+    #Separate fixed params from the varying ones
+    params = fs.separate_fix_from_varying(params)
+
+    #Start loop
+    n_jobs = 0
+    result_ref = None
+    while args.max_jobs is None or n_jobs < args.max_jobs:
+
+        #Claim a job, or wait for new ones until the queue is stopped
+        job, claimed = fs.claim_job(queue, worker_id)
+        if job is None:
+            if os.path.exists(queue + 'stop'):
+                break
+            time.sleep(gv.QUEUE_POLL)
+            continue
+        heartbeat = fs.start_heartbeat(claimed)
+
+        #Run the two versions of class on the sample of the job
+        params = fs.assign_sample(params, job['sample'])
+        has_output = 0
+        runtimes = {}
+        for v in ['v1', 'v2']:
+            runtimes[v] = fs.run_version(params, folders, v)
+            has_output = fs.has_output(folders, v, has_output)
+        fs.print_messages(has_output)
+        fs.clean_ini(job['id'], folders, has_output)
+
+        #Compare output
+        result = {'has_output': has_output, 'runtimes': runtimes}
+        if has_output is 2:
+            data, identical = fs.read_output_pair(folders)
+            output_data.update(data)
+            output_diff = fs.get_output_diff_struct(params, output_data)
+            fs.compare_output(params, output_data, output_diff)
+            result['diff'] = fs.output_diff_to_result(output_diff)
+            result['identical'] = identical
+            if wargs.ref:
+                if result_ref is None:
+                    output_diff = fs.get_output_diff_struct(params,
+                        output_data)
+                    fs.compare_output(params, output_data, output_diff,
+                        mode='ref')
+                    result_ref = fs.output_diff_to_result(output_diff)
+                result['ref'] = result_ref
+
+        #Post the result
+        heartbeat.set()
+        fs.post_result(queue, job, result, claimed)
+        fs.clean_workspace(folders['tmp'])
+        n_jobs += 1
+        print 'Completed job ' + str(job['id'])
+        sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
+
+
+    return
+
+
+def boundary(args):
+    """
+    Locate the boundary of a one-sided failure. The main steps are:
+      (i) Read the failing ini files (from ini_to_check/) and a
+          known-good sample, and find the parameters where they differ
+     (ii) Reset in parallel each of these parameters to its good value,
+          keeping only the ones needed to reproduce the failure
+    (iii) Bisect the segment between the good sample and the minimal
+          failing one, running several probes in parallel per round
+     (iv) Output the minimal failing ini files and the boundary location
+
+    A probe is failing if only one version of (hi_)class generates output
+    """
+
+    #Read input parameters and create the folder structure
+    params = fs.read_input_parameters(args)
+    params = fs.get_output_path_and_name(params)
+    params, folders = fs.create_folders(args, params)
+
+    #Read the failing and the good samples
+    inis = {}
+    inis['v1'] = fs.read_ini_file(args.ini_v1)
+    inis['v2'] = fs.read_ini_file(args.ini_v2)
+    good = fs.read_ini_file(args.good)
+    dims = fs.boundary_dims(inis, good)
+    if not dims:
+        raise IOError('--------> The failing and the good samples are equal!')
+
+    #Check the good and the failing samples
+    outputs = fs.run_probes(folders, [fs.probe_inis(inis, dims, 0.),
+        fs.probe_inis(inis, dims, 1.)], args.processes)
+    n_runs = 2
+    if outputs[0] is 1:
+        raise IOError('--------> The good sample fails on one version!')
+    if outputs[1] is not 1:
+        raise IOError('--------> The failing sample does not fail '
+            'on one version only!')
+
+    #Reset each parameter to its good value. The ones that can be
+    #reset without removing the failure are not needed
+    outputs = fs.run_probes(folders,
+        [fs.probe_inis(inis, dims, 1., reset=[n]) for n in range(len(dims))],
+        args.processes)
+    n_runs += len(dims)
+    reset = [n for n in range(len(dims)) if outputs[n] is 1]
+    if len(reset) > 1:
+        outputs = fs.run_probes(folders,
+            [fs.probe_inis(inis, dims, 1., reset=reset)], args.processes)
+        n_runs += 1
+        #If they can not be reset all together, reset them one at a time
+        if outputs[0] is not 1:
+            kept = []
+            for n in reset:
+                outputs = fs.run_probes(folders,
+                    [fs.probe_inis(inis, dims, 1., reset=kept + [n])], 1)
+                n_runs += 1
+                if outputs[0] is 1:
+                    kept.append(n)
+            reset = kept
+    for (n, (key, i, val_good, val_fail)) in enumerate(dims):
+        if n not in reset:
+            print '----> Needed to fail: ' + key + '[' + str(i) + '] from ' \
+                + repr(val_good) + ' to ' + repr(val_fail)
+    sys.stdout.flush()
+
+    #Bisect the segment between the good (t=0) and the failing (t=1)
+    #samples, with one probe per process in each round
+    (t_lo, t_hi) = (0., 1.)
+    while t_hi - t_lo > args.tol:
+        ts = [t_lo + (t_hi - t_lo)*(n+1.)/(args.processes+1.)
+            for n in range(args.processes)]
+        outputs = fs.run_probes(folders,
+            [fs.probe_inis(inis, dims, t, reset) for t in ts], args.processes)
+        n_runs += len(ts)
+        for (t, output) in zip(ts, outputs):
+            if output is 1:
+                t_hi = t
+                break
+            t_lo = t
+        print '----> Boundary in t = [%.6e, %.6e]' % (t_lo, t_hi)
+        sys.stdout.flush()
+
+    #Write the minimal failing ini files
+    minimal = fs.probe_inis(inis, dims, t_hi, reset)
+    prefix = folders['main'] + folders['f_prefix']
+    for v in ['v1', 'v2']:
+        fname = fs.write_ini_dict(minimal[v], prefix + 'boundary_' + v + '.ini')
+        print 'Saved minimal failing ini in ' + os.path.relpath(fname)
+
+    #Write the boundary location
+    good_side = fs.probe_inis(inis, dims, t_lo, reset)
+    with fs.atomic_open(prefix + 'boundary.txt') as f:
+        f.write('#Failing ini files: ' + args.ini_v1 + ', ' + args.ini_v2 + '\n')
+        f.write('#Good sample: ' + args.good + '\n')
+        f.write('#Number of (hi_)class runs: ' + str(2*n_runs) + '\n')
+        f.write('#parameter    good    boundary_good_side    '
+            'boundary_failing_side    failing\n')
+        for (n, (key, i, val_good, val_fail)) in enumerate(dims):
+            if n in reset:
+                continue
+            f.write(key + '[' + str(i) + ']    ' + '    '.join(['%.10e' % x
+                for x in [val_good,
+                fs.parse_numeric(good_side['v1'][key])[i],
+                fs.parse_numeric(minimal['v1'][key])[i],
+                val_fail]]) + '\n')
+    print 'Saved boundary in ' + os.path.relpath(prefix + 'boundary.txt')
+    print 'Number of (hi_)class runs: ' + str(2*n_runs)
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
+    try:
+        os.rmdir(folders['ini_to_check'])
+    except:
+        pass
+
+
+    return
+
+
+def bisect(args):
+    """
+    Find the first commit of (hi_)class that changes the output
+    beyond a threshold. The main steps are:
+      (i) List the commits between the good and the bad ones
+     (ii) Build the good and the bad commits and run them on a
+          fixed set of random samples
+    (iii) Search the first bad commit, building and running several
+          commits in parallel per round (k-ary search)
+     (iv) Output the max percentage diff of each tested commit
+
+    The builds are stored in a cache, with one folder per source tree
+    """
+
+    from multiprocessing.pool import ThreadPool
+
+    #Read input parameters and create the folder structure. The
+    #installation folders of class are replaced by the builds
+    params = fs.read_input_parameters(args)
+    params['common'].setdefault('root_class_v1', args.repo)
+    params['common'].setdefault('root_class_v2', args.repo)
+    params = fs.get_output_path_and_name(params)
+    params, folders = fs.create_folders(args, params)
+    params = fs.separate_fix_from_varying(params)
+    repo = fs.folder_exists_or(args.repo, mod='error')
+    if args.cache:
+        cache = fs.folder_exists_or(args.cache, mod='create')
+    else:
+        cache = fs.folder_exists_or(folders['main'] + 'build_cache/',
+            mod='create')
+
+    #List the commits (0 is the good one, the last is the bad one)
+    commits = fs.list_commits(repo, args.good, args.bad)
+    print '----> Commits between good and bad: ' + str(len(commits) - 1)
+
+    #Fixed set of random samples
+    random.seed(args.seed)
+    samples = []
+    for n in range(args.N):
+        params = fs.generate_random_params(params)
+        samples.append(fs.get_sample(params))
+
+    #Search the first bad commit. The first round tests the good and the
+    #bad commits, the next ones the commits between the last good and
+    #the first bad. A commit that does not build is skipped
+    pool = ThreadPool(args.processes)
+    diffs = {}
+    (lo, hi) = (0, len(commits) - 1)
+    probes = [lo, hi]
+    while probes:
+        builds = pool.map(lambda n: fs.build_commit(repo, cache, commits[n],
+            args.make_args), probes)
+        for (n, build) in zip(probes, builds):
+            if build is None and n == 0:
+                raise IOError('--------> The good commit does not build!')
+            elif build is None:
+                print '----> Skipped ' + commits[n][:10] + ' (build failed)'
+                diffs[n] = None
+                continue
+            outputs = fs.run_build(folders, params, build, samples, pool)
+            #The samples where the good commit has no output are removed
+            if n == 0:
+                samples = [x for (x, y) in zip(samples, outputs) if y]
+                ref_outputs = [y for y in outputs if y]
+                outputs = ref_outputs
+                if not samples:
+                    raise IOError('--------> The good commit has no output!')
+            diffs[n] = fs.max_diff_wrt(params, ref_outputs, outputs)
+        if diffs[len(commits) - 1] is None:
+            raise IOError('--------> The bad commit does not build!')
+        if diffs[len(commits) - 1] <= args.threshold:
+            raise IOError('--------> The bad commit is not bad '
+                '(max diff = %.3e%%)!' % diffs[len(commits) - 1])
+        #Update the bracket
+        for n in range(lo + 1, hi + 1):
+            if diffs.get(n) is None:
+                continue
+            if diffs[n] > args.threshold:
+                hi = n
+                break
+            lo = n
+        print '----> First bad commit in (' + commits[lo][:10] + ', ' \
+            + commits[hi][:10] + ']'
+        sys.stdout.flush()
+        #Next probes, equally spaced among the untested commits
+        candidates = [n for n in range(lo + 1, hi) if n not in diffs]
+        k = min(args.processes, len(candidates))
+        probes = sorted(set(candidates[len(candidates)*(m + 1)/(k + 1)]
+            for m in range(k)))
+    pool.close()
+    pool.join()
+
+    #Write the tested commits
+    fname = folders['main'] + folders['f_prefix'] + 'bisect.txt'
+    with fs.atomic_open(fname) as f:
+        f.write('#Good commit: ' + commits[0] + '\n')
+        f.write('#Bad commit: ' + commits[-1] + '\n')
+        f.write('#Threshold: ' + str(args.threshold) + '%\n')
+        f.write('#Number of samples: ' + str(len(samples)) + '\n')
+        f.write('#First bad commit: ' + commits[hi] + '\n')
+        f.write('#commit    max_diff    status    subject\n')
+        for n in sorted(diffs.keys()):
+            if diffs[n] is None:
+                (diff, status) = ('nan', 'skip')
+            else:
+                diff = '%.10e' % diffs[n]
+                status = 'bad' if diffs[n] > args.threshold else 'good'
+            f.write(commits[n] + '    ' + diff + '    ' + status + '    '
+                + fs.git_output(repo, 'log', '-1', '--format=%s', commits[n])
+                + '\n')
+    skipped = [commits[n] for n in range(lo + 1, hi) if diffs.get(n, 1) is None]
+    if skipped:
+        print 'The first bad commit is ' + commits[hi] + ' or one of the ' \
+            'commits that do not build: ' + ', '.join(skipped)
+    else:
+        print 'The first bad commit is ' + commits[hi]
+    print fs.git_output(repo, 'log', '-1', '--format=    %s', commits[hi])
+    print 'Saved tested commits in ' + os.path.relpath(fname)
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
+    try:
+        os.rmdir(folders['ini_to_check'])
+    except:
+        pass
+
+
+    return
+
+
+def screen(args):
+    """
+    Screen the varying parameters with the Morris method.
+    The main steps are:
+      (i) Generate random one-at-a-time trajectories on a grid
+          in the space of the varying parameters
+     (ii) Run the two versions of class on each point of the
+          trajectories and calculate the diffs
+    (iii) Calculate the elementary effect of each parameter on
+          each diff (change of the diff per step of the parameter)
+     (iv) Rank the parameters by mu* (mean of the absolute
+          elementary effects) and output the ranking
+      (v) Output a reduced ini, where the unimportant parameters
+          are fixed at their nominal values (centre of the prior)
+    """
+
+    #Read input parameters and create the folder structure
+    params = fs.read_input_parameters(args)
+    params = fs.get_output_path_and_name(params)
+    params, folders = fs.create_folders(args, params)
+    params = fs.separate_fix_from_varying(params)
+    space = params['space']
+    names = space['names'][:space['n_var']]
+    if not names:
+        raise IOError('--------> No varying parameters to screen!')
+    if args.levels < 2:
+        raise IOError('--------> At least two levels are needed!')
+
+    #Run the trajectories
+    random.seed(args.seed)
+    effects = {}
+    step = 0
+    for n in range(args.trajectories):
+        (points, order, deltas) = fs.morris_trajectory(len(names),
+            args.levels)
+        results = []
+        for u in points:
+            step += 1
+            params = fs.assign_sample(params, fs.unit_to_sample(params, u))
+            has_output = 0
+            for v in ['v1', 'v2']:
+                fs.run_version(params, folders, v)
+                has_output = fs.has_output(folders, v, has_output)
+            fs.print_messages(has_output)
+            fs.clean_ini(step, folders, has_output)
+            if has_output is 2:
+                output_data, identical = fs.read_output_pair(folders)
+                output_diff = fs.get_output_diff_struct(params, output_data)
+                fs.compare_output(params, output_data, output_diff)
+                result = fs.output_diff_to_result(output_diff)
+                results.append(dict((f + ':' + k, result[f][k])
+                    for f in result.keys() for k in result[f].keys()))
+            else:
+                results.append(None)
+            fs.clean_workspace(folders['tmp'])
+        effects = fs.elementary_effects(effects, results, order, deltas)
+        print 'Completed trajectory ' + str(n+1) + ' of ' \
+            + str(args.trajectories)
+        sys.stdout.flush()
+
+    #Rank the parameters
+    summary, score = fs.screen_summary(effects, names, args.mu_min)
+    fname = fs.write_screen_file(summary, folders)
+    print 'Saved ranking in ' + os.path.relpath(fname)
+
+    #Fix the unimportant parameters at the centre of their prior. The
+    #parameters needed by the derived ones are kept varying
+    needed = set()
+    for code in space['derived']:
+        needed.update(code.co_names)
+    nominal = fs.unit_to_sample(params, [0.5]*len(names))
+    fixed = {}
+    for k in sorted(names, key=lambda x: -score[x]):
+        if score[k] < args.threshold and k not in needed:
+            fixed[k] = nominal[k]
+            status = 'fixed at ' + repr(nominal[k])
+        else:
+            status = 'kept'
+        print '----> %s: score = %.3f, %s' % (k, score[k], status)
+    fname = fs.write_reduced_ini(args.input_file, fixed, folders)
+    print 'Saved reduced ini in ' + os.path.relpath(fname) + ' (' \
+        + str(len(names) - len(fixed)) + ' of ' + str(len(names)) \
+        + ' parameters varying)'
+    sys.stdout.flush()
+
+    #Clean output folders
+    fs.release_workspace(folders['tmp'])
+    try:
+        os.rmdir(folders['ini_to_check'])
+    except:
+        pass
+
+
+    return
+
+
+def rediff(args):
+    """
+    Recompute the diffs from the archive generated with
+    "run --archive", without running (hi_)class.
+    The shards of the archive are processed in parallel.
+    """
+
+    import glob
+    import multiprocessing
+
+    #Folders
+    folders = {}
+    folders['archive'] = fs.folder_exists_or(args.archive_dir, mod='error')
+    folders['main'] = os.path.abspath(folders['archive'] + '..') + '/'
+    shards = sorted(glob.glob(folders['archive'] + '*shard_*.npz'))
+    if not shards:
+        raise IOError('--------> No archive found in ' + args.archive_dir)
+    folders['f_prefix'] = os.path.basename(shards[0])[:-len('shard_0001.npz')]
+
+    #Reference output
+    try:
+        ref = fs.read_archive_file(folders['archive'] + 'ref.npz')
+    except IOError:
+        ref = None
+
+    #Ranges of the independent variables
+    x_range = {}
+    for xr in args.x_range:
+        (f, xmin, xmax) = xr.split(':')
+        x_range[f] = (float(xmin), float(xmax))
+
+    #Metrics for each file
+    metrics = {}
+    for m in args.metrics:
+        (f, metric) = m.split(':', 1)
+        metrics.setdefault(f, []).append(metric)
+
+    #Recompute the diffs of each shard in parallel
+    jobs = [(x, ref, args.vars, x_range, metrics) for x in shards]
+    pool = multiprocessing.Pool(args.processes)
+    results = pool.map(fs.rediff_shard, jobs)
+    pool.close()
+    pool.join()
+
+    #Merge the diffs, sorted by step
+    output_diff = {}
+    for (step, diff) in sorted(sum(results, [])):
+        fs.merge_output_diff(output_diff, diff)
+    if not output_diff:
+        raise IOError('--------> The archive is empty!')
+
+    #Write output
+    output_path = fs.write_output_file(output_diff, folders, mode='rediff')
+    print 'Saved output table in ' + os.path.relpath(output_path)
+    #Write output ref
+    if ref:
+        output_data = fs.read_archive_file(shards[0])
+        output_data = output_data[sorted(output_data.keys(), key=int)[0]]
+        if args.vars:
+            for v in ['v1', 'v2']:
+                output_data[v] = fs.select_variables(output_data[v], args.vars)
+        output_data.update(ref)
+        params = {'var': {}, 'metrics': metrics}
+        output_diff_ref = fs.get_output_diff_struct(params, output_data)
+        fs.compare_output(params, output_data, output_diff_ref, mode='ref',
+            x_range=x_range)
+        output_path = fs.write_output_file(output_diff_ref, folders,
+            mode='rediff_ref')
+        print 'Saved output ref table in ' + os.path.relpath(output_path)
+
+    #If requested, generate plots
+    if args.want_plots:
+        folders['plots'] = fs.folder_exists_or(folders['main'] + 'plots/',
+            mod='create')
+        fname = folders['main'] + folders['f_prefix'] + 'rediff_output.dat'
+        data_plots = fs.read_output_table(fname)
+        fname = folders['main'] + folders['f_prefix'] + 'rediff_ref_output.dat'
+        try:
+            data_plots_ref = fs.read_output_table(fname)
+        except:
+            data_plots_ref = None
+        fs.generate_plots(data_plots, data_plots_ref, folders['plots'])
+        print 'Saved figures in ' + os.path.relpath(folders['plots'])
+    sys.stdout.flush()
+
 
-def update(args):
     return
 
 
@@ -217,3 +1274,19 @@ if __name__ == '__main__':
         sys.exit(run(args))
     elif args.mode == 'info':
         sys.exit(info(args))
+    elif args.mode == 'ladder':
+        sys.exit(ladder(args))
+    elif args.mode == 'bank':
+        sys.exit(bank(args))
+    elif args.mode == 'rediff':
+        sys.exit(rediff(args))
+    elif args.mode == 'coordinator':
+        sys.exit(coordinator(args))
+    elif args.mode == 'worker':
+        sys.exit(worker(args))
+    elif args.mode == 'boundary':
+        sys.exit(boundary(args))
+    elif args.mode == 'bisect':
+        sys.exit(bisect(args))
+    elif args.mode == 'screen':
+        sys.exit(screen(args))
@@ -1,15 +1,26 @@
 #This module contains all the functions needed by the compare.py module.
 import os
 import re
+import math
 import sys
 import shutil
 import argparse
 import random
 import subprocess
+import multiprocessing
 import fnmatch
+import time
+import glob
+import hashlib
+import json
+import threading
+import socket
+import uuid
+import errno
+import contextlib
+from StringIO import StringIO
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import interpolate
 import global_variables as gv
 
 
@@ -35,6 +46,14 @@ def argument_parser():
     run_parser = subparsers.add_parser('run')
     update_parser = subparsers.add_parser('update')
     info_parser = subparsers.add_parser('info')
+    ladder_parser = subparsers.add_parser('ladder')
+    bank_parser = subparsers.add_parser('bank')
+    rediff_parser = subparsers.add_parser('rediff')
+    coordinator_parser = subparsers.add_parser('coordinator')
+    worker_parser = subparsers.add_parser('worker')
+    boundary_parser = subparsers.add_parser('boundary')
+    bisect_parser = subparsers.add_parser('bisect')
+    screen_parser = subparsers.add_parser('screen')
 
     #Arguments for 'run'
     run_parser.add_argument('input_file', type=str, help='Input file')
@@ -48,6 +67,27 @@ def argument_parser():
     help='Number of iterations (default = 1)')
     run_parser.add_argument('--want-plots', action='store_true',
     help='Generate plots from the output')
+    run_parser.add_argument('--against-bank', type=str, default = None,
+    help='Folder of a bank generated with the "bank" mode. Only class-v2 '
+    'is run, on the samples of the bank (-N is ignored)')
+    run_parser.add_argument('--archive', action='store_true',
+    help='Archive the output of each successful sample in archive/, '
+    'to be used with the "rediff" mode')
+    run_parser.add_argument('--archive-batch', type=int, default=100,
+    help='Number of samples per archive shard (default = 100)')
+    run_parser.add_argument('--metrics-file', type=str, default=None,
+    help='File where the telemetry is written in Prometheus text format')
+    run_parser.add_argument('--metrics-port', type=int, default=None,
+    help='Serve the telemetry on http://localhost:<port>/metrics '
+    '(Prometheus text) and /status (json)')
+    run_parser.add_argument('--budget', type=float, default=None,
+    help='Budget in node-hours. N is the largest number of samples that '
+    'fits in it, estimated from the runtimes of the previous runs')
+    run_parser.add_argument('--low-memory', action='store_true',
+    help='Compare the output files chunk by chunk, without loading them '
+    'in memory (not available with --against-bank and --archive)')
+    run_parser.add_argument('--float32', action='store_true',
+    help='With --low-memory, store the chunks in single precision')
 
     #Arguments for update
     update_parser.add_argument('input_file', type=str, help='Input file')
@@ -61,11 +101,163 @@ def argument_parser():
     help='Reference ini file')
     update_parser.add_argument('--want-plots', action='store_true',
     help='Generate plots from the output')
+    update_parser.set_defaults(against_bank=None, archive=False,
+        metrics_file=None, metrics_port=None, budget=None, low_memory=False,
+        float32=False)
 
     #Arguments for 'info'
     info_parser.add_argument('output_dir', type=str,
     help='Folder where the output is stored')
 
+    #Arguments for 'ladder'
+    ladder_parser.add_argument('input_file', type=str, help='Input file')
+    ladder_parser.add_argument('ladder', type=str, nargs='+',
+    help='Input files with the candidate precision settings, '
+    'run with class-v2')
+    ladder_parser.add_argument('--params-v1', type=str, default = None,
+    help='Input file with the baseline precision settings, '
+    'run with class-v1')
+    ladder_parser.add_argument('-N', type=int, default=2,
+    help='Number of shared samples (default = 2)')
+    ladder_parser.add_argument('--tol', type=float, default=0.1,
+    help='Tolerance on the max percentage diff (default = 0.1)')
+    ladder_parser.set_defaults(params_v2=None, ref=None, want_plots=False)
+
+    #Arguments for 'bank'
+    bank_parser.add_argument('input_file', type=str, help='Input file')
+    bank_parser.add_argument('bank_dir', type=str,
+    help='Folder where the bank is stored')
+    bank_parser.add_argument('--params-v1', type=str, default = None,
+    help='Input file only for class-v1')
+    bank_parser.add_argument('--ref', type=str, default = None,
+    help='Reference ini file')
+    bank_parser.add_argument('-N', type=int, default=2,
+    help='Number of samples in the bank (default = 2)')
+    bank_parser.add_argument('--seed', type=int, default=0,
+    help='Seed of the random samples (default = 0)')
+    bank_parser.set_defaults(params_v2=None, want_plots=False)
+
+    #Arguments for 'rediff'
+    rediff_parser.add_argument('archive_dir', type=str,
+    help='Folder where the archive is stored')
+    rediff_parser.add_argument('--vars', type=str, nargs='+', default=None,
+    help='Variables to compare, in the form file:var (e.g. cl:TT). '
+    'Default: all the archived ones')
+    rediff_parser.add_argument('--x-range', type=str, nargs='+', default=[],
+    help='Range of the independent variable for each file, in the form '
+    'file:xmin:xmax (e.g. cl:2:500)')
+    rediff_parser.add_argument('--metrics', type=str, nargs='+', default=[],
+    help='Metrics for each file, in the form file:metric (e.g. cl:rms '
+    'cl:max[2,30]). Default: the ones in METRICS')
+    rediff_parser.add_argument('-j', '--processes', type=int, default=None,
+    help='Number of parallel processes (default = number of cores)')
+    rediff_parser.add_argument('--want-plots', action='store_true',
+    help='Generate plots from the output')
+
+    #Arguments for 'coordinator'
+    coordinator_parser.add_argument('input_file', type=str, help='Input file')
+    coordinator_parser.add_argument('--params-v1', type=str, default = None,
+    help='Input file only for class-v1')
+    coordinator_parser.add_argument('--params-v2', type=str, default = None,
+    help='Input file only for class-v2')
+    coordinator_parser.add_argument('--ref', type=str, default = None,
+    help='Reference ini file')
+    coordinator_parser.add_argument('-N', type=int, default=2,
+    help='Number of successful samples (default = 2)')
+    coordinator_parser.add_argument('--queue-dir', type=str, default=None,
+    help='Folder of the job queue, on a filesystem shared with the '
+    'workers (default = <root_output>queue/)')
+    coordinator_parser.add_argument('--local-workers', type=int, default=0,
+    help='Number of workers to start on this machine (default = 0)')
+    coordinator_parser.add_argument('--timeout', type=float,
+    default=gv.QUEUE_TIMEOUT, help='Seconds without heartbeat after which '
+    'a claimed job is put back in the queue (default = %(default)s)')
+    coordinator_parser.add_argument('--metrics-file', type=str, default=None,
+    help='File where the telemetry is written in Prometheus text format')
+    coordinator_parser.add_argument('--budget', type=float, default=None,
+    help='Budget in node-hours. N is the largest number of samples that '
+    'fits in it, estimated from the runtimes of the previous runs')
+    coordinator_parser.add_argument('--cores', type=int, default=None,
+    help='Number of workers per node, used to estimate the wall time and '
+    'the node-hours (default = number of local workers, or 1)')
+    coordinator_parser.add_argument('--want-plots', action='store_true',
+    help='Generate plots from the output')
+
+    #Arguments for 'worker'
+    worker_parser.add_argument('queue_dir', type=str,
+    help='Folder of the job queue created by the coordinator')
+    worker_parser.add_argument('--max-jobs', type=int, default=None,
+    help='Exit after this number of jobs (default = no limit)')
+
+    #Arguments for 'boundary'
+    boundary_parser.add_argument('input_file', type=str,
+    help='Input file (only root_output, root_class_v1 and root_class_v2 '
+    'are used)')
+    boundary_parser.add_argument('ini_v1', type=str,
+    help='ini file for class-v1 from ini_to_check/')
+    boundary_parser.add_argument('ini_v2', type=str,
+    help='ini file for class-v2 from ini_to_check/')
+    boundary_parser.add_argument('--good', type=str, required=True,
+    help='ini file with the values of a known-good sample '
+    '(e.g. an ini file of a successful run)')
+    boundary_parser.add_argument('--tol', type=float, default=1.e-3,
+    help='Tolerance on the boundary location, relative to the distance '
+    'between the good and the failing samples (default = 1e-3)')
+    boundary_parser.add_argument('-j', '--processes', type=int,
+    default=multiprocessing.cpu_count(),
+    help='Number of probes run in parallel (default = number of cores)')
+    boundary_parser.set_defaults(params_v1=None, params_v2=None, ref=None,
+        want_plots=False)
+
+    #Arguments for 'bisect'
+    bisect_parser.add_argument('input_file', type=str, help='Input file')
+    bisect_parser.add_argument('--repo', type=str, required=True,
+    help='git repository of (hi_)class')
+    bisect_parser.add_argument('--good', type=str, required=True,
+    help='git ref of the good commit')
+    bisect_parser.add_argument('--bad', type=str, required=True,
+    help='git ref of the bad commit')
+    bisect_parser.add_argument('--threshold', type=float, required=True,
+    help='A commit is bad if its max percentage diff with respect to '
+    'the good commit exceeds this threshold')
+    bisect_parser.add_argument('-N', type=int, default=5,
+    help='Number of samples (default = 5)')
+    bisect_parser.add_argument('--seed', type=int, default=0,
+    help='Seed of the random samples (default = 0)')
+    bisect_parser.add_argument('--cache', type=str, default=None,
+    help='Folder of the build cache (default = <root_output>build_cache/)')
+    bisect_parser.add_argument('--make-args', type=str, default='',
+    help='Additional arguments for make (e.g. "-j4")')
+    bisect_parser.add_argument('-j', '--processes', type=int,
+    default=multiprocessing.cpu_count(),
+    help='Number of commits tested (and of class runs) in parallel '
+    '(default = number of cores)')
+    bisect_parser.set_defaults(params_v1=None, params_v2=None, ref=None,
+        want_plots=False)
+
+    #Arguments for 'screen'
+    screen_parser.add_argument('input_file', type=str, help='Input file')
+    screen_parser.add_argument('--params-v1', type=str,
+    help='Input file with specific parameters for class_v1')
+    screen_parser.add_argument('--params-v2', type=str,
+    help='Input file with specific parameters for class_v2')
+    screen_parser.add_argument('-r', '--trajectories', type=int, default=10,
+    help='Number of Morris trajectories (default = 10). Each trajectory '
+    'runs the two versions of class on (number of varying params + 1) '
+    'samples')
+    screen_parser.add_argument('--levels', type=int, default=4,
+    help='Number of levels of the grid of each parameter (default = 4)')
+    screen_parser.add_argument('--seed', type=int, default=0,
+    help='Seed of the random trajectories (default = 0)')
+    screen_parser.add_argument('--threshold', type=float, default=0.1,
+    help='A parameter is fixed in the reduced ini if, for every variable, '
+    'its mu* is below this fraction of the largest one (default = 0.1)')
+    screen_parser.add_argument('--mu-min', type=float,
+    default=gv.SCREEN_MU_MIN, help='Variables whose largest mu* is below '
+    'this value (roundoff) do not score the parameters (default = '
+    + str(gv.SCREEN_MU_MIN) + ')')
+    screen_parser.set_defaults(ref=None, want_plots=False)
+
     args = parser.parse_args()
 
     return args
@@ -91,6 +283,8 @@ def read_input_parameters(args):
 
     #Read the common parameters
     params['common'] = read_ini_file(args.input_file)
+    #Extract the metrics, if any
+    params = read_metrics(params)
 
     #Read parameters for class_v1
     if args.params_v1:
@@ -105,6 +299,12 @@ def read_input_parameters(args):
         params['ref_v1'] = read_ini_file(args.ref)
         params['ref_v2'] = read_ini_file(args.ref)
 
+    #Read the candidate precision settings of the ladder
+    #(keys: 'v2_1', 'v2_2', ...), all run with class_v2
+    if getattr(args, 'ladder', None):
+        for n, fname in enumerate(args.ladder):
+            params['v2_' + str(n+1)] = read_ini_file(fname)
+
     return params
 
 
@@ -184,7 +384,7 @@ def folder_exists_or(fname, mod = 'error'):
     return abs_path
 
 
-def create_folders(args, params):
+def create_folders(args, params, copy_inputs=True):
     """
     Create folder structure.
 
@@ -211,39 +411,58 @@ def create_folders(args, params):
     folders['v2'] = folder_exists_or(fname, 'error')
     if args.ref:
         folders['ref_v2'] = folders['v2']
+    for v in ladder_versions(params):
+        folders[v] = folders['v2']
+
+    #Create a workspace in the tmp folder (for class output and ini
+    #files), unique to this invocation, after removing the workspaces
+    #left behind by crashed jobs
+    clean_stale_workspaces(folders)
+    folders['tmp'] = create_workspace(folders)
 
-    #Create tmp folder (for class output)
-    fname = folders['main'] + 'tmp/'
-    folders['tmp'] = folder_exists_or(fname, 'create')
+    #Messages already reported in this run (see report_once)
+    folders['reported'] = set()
 
     #Create ini_to_check folder (for ini files that generated
     #output from one version of (hi_)class only)
     fname = folders['main'] + 'ini_to_check/'
     folders['ini_to_check'] = folder_exists_or(fname, 'create')
 
+    #Create archive folder (for the output of each sample)
+    if getattr(args, 'archive', False):
+        fname = folders['main'] + 'archive/'
+        folders['archive'] = folder_exists_or(fname, 'create')
+
     #Create plot folder folder (for class output)
     if args.want_plots:
         fname = folders['main'] + 'plots/'
         folders['plots'] = folder_exists_or(fname, 'create')
 
-    #Create input folder and store input files
-    fname = folders['main'] + 'input_files/'
-    folders['input_files'] = folder_exists_or(fname, 'create')
-    fold = os.path.abspath('.') + '/' + args.input_file
-    fnew = folders['input_files'] + args.input_file.split('/')[-1]
-    shutil.copy2(fold, fnew)
-    if args.params_v1:
-        fold = os.path.abspath('.') + '/' + args.params_v1
-        fnew = folders['input_files'] + args.params_v1.split('/')[-1]
-        shutil.copy2(fold, fnew)
-    if args.params_v2:
-        fold = os.path.abspath('.') + '/' + args.params_v2
-        fnew = folders['input_files'] + args.params_v2.split('/')[-1]
-        shutil.copy2(fold, fnew)
-    if args.ref:
-        fold = os.path.abspath('.') + '/' + args.ref
-        fnew = folders['input_files'] + args.ref.split('/')[-1]
+    #Create input folder and store input files (except for the
+    #workers of a queue, that share the ones of the coordinator)
+    if copy_inputs:
+        fname = folders['main'] + 'input_files/'
+        folders['input_files'] = folder_exists_or(fname, 'create')
+        fold = os.path.abspath('.') + '/' + args.input_file
+        fnew = folders['input_files'] + args.input_file.split('/')[-1]
         shutil.copy2(fold, fnew)
+        if args.params_v1:
+            fold = os.path.abspath('.') + '/' + args.params_v1
+            fnew = folders['input_files'] + args.params_v1.split('/')[-1]
+            shutil.copy2(fold, fnew)
+        if args.params_v2:
+            fold = os.path.abspath('.') + '/' + args.params_v2
+            fnew = folders['input_files'] + args.params_v2.split('/')[-1]
+            shutil.copy2(fold, fnew)
+        if args.ref:
+            fold = os.path.abspath('.') + '/' + args.ref
+            fnew = folders['input_files'] + args.ref.split('/')[-1]
+            shutil.copy2(fold, fnew)
+        if getattr(args, 'ladder', None):
+            for fname in args.ladder:
+                fold = os.path.abspath('.') + '/' + fname
+                fnew = folders['input_files'] + fname.split('/')[-1]
+                shutil.copy2(fold, fnew)
 
     #Assign to params of each version of class the relative path of
     #the tmp folder, which will be used by class to store the outputs
@@ -253,6 +472,8 @@ def create_folders(args, params):
     if args.ref:
         params['ref_v1']['root'] = fname + 'ref_v1_'
         params['ref_v2']['root'] = fname + 'ref_v2_'
+    for v in ladder_versions(params):
+        params[v]['root'] = fname + v + '_'
 
     #Remove roots from params
     params.pop('f_prefix', None)
@@ -263,6 +484,180 @@ def create_folders(args, params):
     return params, folders
 
 
+@contextlib.contextmanager
+def atomic_open(fname, mode='w'):
+    """
+    Open a unique temporary file next to fname and rename
+    it to fname when closed, so that concurrent jobs never
+    see fname half written.
+    """
+
+    tmp = fname + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.rename(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def move_unique(src, dst):
+    """
+    Move src to dst without overwriting existing files.
+    If dst exists, a unique suffix is appended to its name.
+    Return the final path.
+    """
+
+    (base, ext) = os.path.splitext(dst)
+    while True:
+        try:
+            os.link(src, dst)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            dst = base + '_' + uuid.uuid4().hex[:8] + ext
+    os.remove(src)
+
+    return dst
+
+
+def create_workspace(folders):
+    """
+    Create in the tmp folder a workspace unique to this job,
+    protected by the lock file tmp/<id>.lock that contains
+    the host and the pid of the owner.
+    Return the path of the workspace.
+    """
+
+    ws_id = socket.gethostname() + '_' + str(os.getpid()) + '_' \
+        + uuid.uuid4().hex[:8]
+
+    #The lock is created before the workspace, so that a workspace
+    #without lock can only be the leftover of a cleaned one. The tmp
+    #folder is removed by the last job that releases its workspace
+    #(see release_workspace), so it may be created by another job
+    #or disappear before the lock exists: in that case, retry
+    while True:
+        try:
+            root = folder_exists_or(folders['main'] + 'tmp/', 'create')
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        try:
+            fd = os.open(root + ws_id + '.lock',
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    os.write(fd, socket.gethostname() + '\n' + str(os.getpid()) + '\n')
+    os.close(fd)
+    os.mkdir(root + ws_id)
+
+    return root + ws_id + '/'
+
+
+def touch_workspace(path):
+    """
+    Update the time stamp of the lock of a workspace,
+    to show that its owner is still alive.
+    """
+
+    os.utime(path.rstrip('/') + '.lock', None)
+
+    return
+
+
+def clean_workspace(path):
+    """
+    Remove the files in a workspace and update its lock.
+    """
+
+    for file in os.listdir(path):
+        os.remove(path + file)
+    touch_workspace(path)
+
+    return
+
+
+def release_workspace(path):
+    """
+    Remove a workspace and its lock. Remove also the
+    tmp folder if there are no other workspaces in it.
+    """
+
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.remove(path.rstrip('/') + '.lock')
+    except OSError:
+        pass
+    try:
+        os.rmdir(os.path.dirname(path.rstrip('/')))
+    except OSError:
+        pass
+
+    return
+
+
+def is_stale_lock(lock):
+    """
+    Return True if the owner of a workspace lock is dead: on
+    the same host when its pid is not running, on other hosts
+    when the lock has not been updated for STALE_WORKSPACE seconds.
+    """
+
+    try:
+        with open(lock, 'r') as f:
+            (host, pid) = f.read().split()[:2]
+        age = time.time() - os.path.getmtime(lock)
+    except (IOError, OSError, ValueError):
+        return False
+
+    if host != socket.gethostname():
+        return age > gv.STALE_WORKSPACE
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+
+    return False
+
+
+def clean_stale_workspaces(folders):
+    """
+    Remove the workspaces in tmp/ left behind by crashed jobs.
+    Each stale lock is first renamed, so that only one job
+    removes the corresponding workspace.
+    """
+
+    root = folders['main'] + 'tmp/'
+    if not os.path.isdir(root):
+        return
+
+    for lock in glob.glob(root + '*.lock'):
+        if not is_stale_lock(lock):
+            continue
+        claimed = lock + '.' + uuid.uuid4().hex[:8] + '.stale'
+        try:
+            os.rename(lock, claimed)
+        except OSError:
+            continue
+        shutil.rmtree(lock[:-len('.lock')], ignore_errors=True)
+        os.remove(claimed)
+        print '--------> Removed stale workspace ' + os.path.relpath(lock[:-5])
+
+    #Workspaces without lock, left by interrupted cleanings
+    for path in glob.glob(root + '*'):
+        if os.path.isdir(path) and not os.path.exists(path + '.lock') \
+            and time.time() - os.path.getmtime(path) > gv.STALE_WORKSPACE:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return
+
+
 def prepare_ref_params(params):
     """
     Prepare params for reference models
@@ -298,54 +693,254 @@ def separate_fix_from_varying(params):
     """
     Restructure the params dict.
 
-    Divide the 'common' params into fixed and varying.
+    Divide the 'common' params into fixed, varying and derived.
     Fixed params are copied in both 'v1' and 'v2'.
-    Varying are copied in 'var'. 'common' is removed.
+    Varying are copied in 'var', derived in 'derived'.
+    'common' is removed and the parameter space is compiled.
     """
 
     #Initialize key var, where all the varying params
-    #are stored.
+    #are stored, and key derived (with their expressions)
     params['var'] = {}
+    params['derived'] = {}
     #For each key, if it is a range move it to 'var'
     for key in params['common']:
-        val = params['common'][key].split(',')
-        if len(val) == 2:
-            try:
-                float(val[0].strip())
-                float(val[1].strip())
-
-                params['var'][key] = params['common'][key]
-            except:
-                pass
-
-    #Remove the varying keys from 'common'
-    for key in params['var'].keys():
+        val = params['common'][key]
+        if val.startswith('derived:'):
+            params['derived'][key] = val[len('derived:'):].strip()
+        elif parse_prior(val):
+            params['var'][key] = val
+
+    #Remove the varying and derived keys from 'common'
+    for key in params['var'].keys() + params['derived'].keys():
         params['common'].pop(key, None)
 
     #Copy fixed keys from 'common' to 'v1' and 'v2'
+    #(and to the candidates of the ladder, if any)
     for key in params['common'].keys():
-        params['v1'][key] = params['common'][key]
-        params['v2'][key] = params['common'][key]
+        for v in ['v1', 'v2'] + ladder_versions(params):
+            params[v][key] = params['common'][key]
 
     #Remove the 'common' key
     params.pop('common', None)
 
+    #Compile the parameter space
+    params = compile_space(params)
+
+    return params
+
+
+def parse_prior(val):
+    """
+    Parse the range of a varying parameter, 'xmin, xmax'
+    with an optional prior ('lin', default, or 'log').
+    Return (xmin, xmax, log), or None if val is not a range.
+    """
+
+    val = [x.strip() for x in val.split(',')]
+    if len(val) == 3 and val[2] in ['lin', 'log']:
+        log = val.pop() == 'log'
+    else:
+        log = False
+    if len(val) != 2:
+        return None
+    try:
+        xmin = float(val[0])
+        xmax = float(val[1])
+    except ValueError:
+        return None
+
+    return (xmin, xmax, log)
+
+
+def compile_space(params):
+    """
+    Compile the parameter space into params['space'], a dict with
+    the names of the varying and derived parameters, their priors,
+    the vector with the values of the current sample and the ini
+    template of each version of class. A sample only fills the
+    vector and renders the templates.
+    """
+
+    space = {}
+    names = sorted(params['var'].keys())
+    priors = [parse_prior(params['var'][k]) for k in names]
+    for (k, (xmin, xmax, log)) in zip(names, priors):
+        if log and (xmin <= 0. or xmax <= 0.):
+            raise IOError('--------> The range of ' + k + ' has to be '
+                'positive for a log prior!')
+    #Priors, uniform in [lo, lo+width] (in log space for the log ones)
+    space['log'] = np.array([x[2] for x in priors], dtype=bool)
+    space['lo'] = np.array([np.log(x[0]) if x[2] else x[0] for x in priors])
+    space['width'] = np.array([np.log(x[1]/x[0]) if x[2] else x[1] - x[0]
+        for x in priors])
+
+    #Derived parameters, evaluated after the varying ones
+    space['namespace'] = dict((k, getattr(math, k)) for k in dir(math)
+        if not k.startswith('_'))
+    space['namespace']['np'] = np
+    space['namespace']['__builtins__'] = {'abs': abs, 'min': min, 'max': max,
+        'float': float}
+    derived = order_derived(params.get('derived', {}), names,
+        space['namespace'])
+
+    #Vector of the current sample: varying, then derived parameters
+    space['names'] = names + [k for (k, code) in derived]
+    space['n_var'] = len(names)
+    space['derived'] = [code for (k, code) in derived]
+    space['vector'] = np.zeros(len(space['names']))
+
+    #Ini templates
+    space['templates'] = {}
+    for v in ['v1', 'v2'] + ladder_versions(params):
+        space['templates'][v] = ini_template(params[v], space['names'])
+
+    params['space'] = space
+
     return params
 
 
+def order_derived(derived, names, namespace):
+    """
+    Compile the expressions of the derived parameters and return
+    a list of (key, code), where each expression depends only on
+    the varying parameters (names) and the previous ones.
+    """
+
+    todo = {}
+    for key in derived.keys():
+        try:
+            todo[key] = compile(derived[key], key, 'eval')
+        except SyntaxError:
+            raise IOError('--------> Invalid expression for ' + key + ': '
+                + derived[key])
+
+    ordered = []
+    known = list(names)
+    while todo:
+        ready = []
+        for key in sorted(todo.keys()):
+            #Try the expression with dummy values
+            try:
+                eval(todo[key], namespace, dict((k, 1.) for k in known))
+            except NameError:
+                continue
+            except Exception:
+                pass
+            ready.append(key)
+        if not ready:
+            raise IOError('--------> Unable to evaluate the derived '
+                'parameters: ' + ', '.join(sorted(todo.keys())))
+        for key in ready:
+            ordered.append((key, todo.pop(key)))
+            known.append(key)
+
+    return ordered
+
+
+def ini_template(fixed, names):
+    """
+    Return the ini template of a version of class, given the
+    dict of its fixed parameters and the names of the varying
+    and derived ones. The template is a tuple (text, idx), where
+    text has a placeholder for the root and one for each value,
+    that is taken from the vector of the sample at position idx.
+    Array parameters (key__1, key__2, ...) are grouped together.
+    """
+
+    #Value of each key: the fixed string or the position in the vector
+    slots = {}
+    for key in fixed.keys():
+        if key != 'root':
+            slots[key] = str(fixed[key]).replace('%', '%%')
+    for (i, key) in enumerate(names):
+        slots[key] = i
+
+    #Group the array parameters
+    groups = {}
+    for key in slots.keys():
+        match = re.match('(.+)__(\d+)$', key)
+        if match:
+            groups.setdefault(match.group(1), []).append(
+                (int(match.group(2)), slots.pop(key)))
+    for key in groups.keys():
+        slots[key] = [x[1] for x in sorted(groups[key])]
+
+    text = 'root = %s\n'
+    idx = []
+    for key in sorted(slots.keys()):
+        line = []
+        for val in (slots[key] if type(slots[key]) is list else [slots[key]]):
+            if type(val) is int:
+                line.append('%r')
+                idx.append(val)
+            else:
+                line.append(val)
+        text += key.replace('%', '%%') + ' = ' + ','.join(line) + '\n'
+
+    return (text, np.array(idx, dtype=int))
+
+
+def compute_derived(space, vector):
+    """
+    Fill the derived parameters of the vector
+    from its varying ones.
+    """
+
+    n_var = space['n_var']
+    if space['derived']:
+        values = dict(zip(space['names'][:n_var], vector[:n_var].tolist()))
+        for (i, code) in enumerate(space['derived']):
+            val = float(eval(code, space['namespace'], values))
+            vector[n_var + i] = val
+            values[space['names'][n_var + i]] = val
+
+    return vector
+
+
+def render_ini(params, v, vector=None, root=None):
+    """
+    Return the content of the ini file of the version v of class
+    for a sample (by default the current one, stored in the vector
+    of the parameter space) and a root (by default the one of v).
+    """
+
+    space = params['space']
+    if vector is None:
+        vector = space['vector']
+    if root is None:
+        root = params[v]['root']
+    (text, idx) = space['templates'][v]
+
+    return text % ((root,) + tuple(vector.take(idx).tolist()))
+
+
+def ladder_versions(params):
+    """
+    Return the sorted list of the keys of params
+    corresponding to the candidates of the ladder.
+    """
+
+    versions = [x for x in params.keys() if re.match('v2_\d+$', x)]
+    versions.sort(key=lambda x: int(x.split('_')[-1]))
+
+    return versions
+
+
 def generate_random_params(params):
     """
-    Return the params dict with random values
-    instead of ranges.
+    Return the params dict with random values of the varying
+    parameters (and the derived ones) in the vector of the sample.
     """
 
-    for key in params['var']:
-        val = params['var'][key].split(',')
-        xmin = float(val[0].strip())
-        xmax = float(val[1].strip())
-        rnd = random.uniform(xmin, xmax)
-        params['v1'][key] = rnd
-        params['v2'][key] = rnd
+    space = params['space']
+    x = space['vector'][:space['n_var']]
+    for i in range(len(x)):
+        x[i] = random.random()
+    np.multiply(x, space['width'], out=x)
+    np.add(x, space['lo'], out=x)
+    np.exp(x, out=x, where=space['log'])
+    compute_derived(space, space['vector'])
 
     return params
 
@@ -358,23 +953,17 @@ def group_parameters(params):
     Return an updated dict of params.
     """
 
-    #Find keys that end with __1
-    new_keys = []
+    #Collect the values of the keys that end with __i
+    groups = {}
     for key in params.keys():
-        if '__1' in key:
-            new_keys.append(key.strip('__1'))
-
-    for new_key in new_keys:
-        count=0
-        new_val = ''
-        for key in params.keys():
-            if new_key + '__' in key:
-                count += 1
-        for i in range(count):
-            old_key = new_key + '__' + str(i+1)
-            new_val += str(params[old_key]) + ','
-        new_val = new_val[:-1]
-        params[new_key] = new_val
+        match = re.match('(.+)__(\d+)$', key)
+        if match:
+            groups.setdefault(match.group(1), {})[int(match.group(2))] = \
+                params[key]
+
+    for new_key in groups.keys():
+        new_val = [str(groups[new_key][i]) for i in sorted(groups[new_key])]
+        params[new_key] = ','.join(new_val)
 
     return params
 
@@ -386,7 +975,7 @@ def create_ini_file(params, folders, v):
     Store the ini path in folders.
     """
 
-    ini_path = folders['main'] + folders['f_prefix'] + v + '.ini'
+    ini_path = folders['tmp'] + folders['f_prefix'] + v + '.ini'
     #Create ini file
     with open(ini_path, 'w') as f:
         for k in params.keys():
@@ -399,18 +988,100 @@ def create_ini_file(params, folders, v):
     return folders
 
 
+def create_sample_ini(params, folders, v, vector=None, root=None):
+    """
+    Create the ini file of the version v of class for a
+    sample from its template (see render_ini) and write it
+    in the output folder. Store the ini path in folders.
+    """
+
+    ini_path = folders['tmp'] + folders['f_prefix'] + v + '.ini'
+    with open(ini_path, 'w') as f:
+        f.write(render_ini(params, v, vector, root))
+
+    #Store ini path
+    folders['ini_' + v] = ini_path
+
+    return folders
+
+
 def run_class(folders, v):
     """
     Run the current version of class
+    and return its runtime in seconds.
     """
     #Get the path to class
     class_path = folders[v] + 'class'
     #Run class
+    start = time.time()
     subprocess.call([class_path, folders['ini_' + v]])
 
+    return time.time() - start
+
+
+def run_version(params, folders, v):
+    """
+    Create the ini file and run the version v of class
+    on the current sample (or with its own parameters if
+    v has no template). Return its runtime in seconds.
+    """
+
+    #Create ini files
+    if v in params.get('space', {}).get('templates', {}):
+        folders = create_sample_ini(params, folders, v)
+    else:
+        params[v] = group_parameters(params[v])
+        folders = create_ini_file(params[v], folders, v)
+    #Run class
+    runtime = run_class(folders, v)
+    #Log the runtimes of the samples, for the cost model
+    if v in params.get('space', {}).get('templates', {}):
+        record_runtime(params, folders, v, runtime)
+
+    return runtime
+
+
+def record_runtime(params, folders, v, runtime):
+    """
+    Append to the runtime log (a json line per run, shared by all
+    the jobs writing in the same output folder) the runtime of the
+    version v of class on the current sample and its outcome.
+    """
+
+    record = {'v': v, 'runtime': runtime,
+        'output': has_output(folders, v, 0), 'sample': get_sample(params)}
+    line = json.dumps(record, sort_keys=True) + '\n'
+    #A single write in append mode, so lines of concurrent jobs do not mix
+    fd = os.open(folders['main'] + folders['f_prefix'] + 'runtimes.log',
+        os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
     return
 
 
+def read_runtime_log(folders):
+    """
+    Return the list of the records of the runtime log.
+    """
+
+    records = []
+    try:
+        with open(folders['main'] + folders['f_prefix'] + 'runtimes.log',
+            'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+
+    return records
+
+
 def has_output(folders, v, output):
     """
     Check if run_class generated the requested output
@@ -418,7 +1089,7 @@ def has_output(folders, v, output):
     """
 
     #File name to match to check if output was generated
-    fname = folders['f_prefix'] + v + '*'
+    fname = folders['f_prefix'] + v + '_*'
     #List of files matching the pattern fname
     match = fnmatch.filter(os.listdir(folders['tmp']), fname)
     #Add to output 1 if the list is not empty
@@ -449,246 +1120,2261 @@ def print_messages(output):
     return
 
 
-def clean_ini(step, folders, output):
+def clean_ini(step, folders, output, versions=None):
     """
     If only one version of (hi_)class generated output
     store the ini files in the ini_to_check/ folder,
     otherwise delete them.
     """
 
-    #Define folders
-    main = folders['main']
-    ini = folders['ini_to_check']
+    if versions is None:
+        versions = ['v1', 'v2']
+
+    #Define folders (ini_to_check/ may have been removed at
+    #the end of a concurrent job sharing the same output folder)
+    ini = folder_exists_or(folders['ini_to_check'], 'create')
 
-    for v in ['ini_v1', 'ini_v2']:
+    for v in ['ini_' + x for x in versions]:
         #If one output store ini files
         if output is 1:
-            new_ini = re.sub(main, '', folders[v])
+            new_ini = os.path.basename(folders[v])
             new_ini = re.sub('.ini', '_' + str(step) + '.ini', new_ini)
             new_ini = ini + new_ini
-            os.rename(folders[v], new_ini)
+            move_unique(folders[v], new_ini)
         else:
             os.remove(folders[v])
 
     return
 
 
-def read_output(folders, v):
+def init_telemetry(n_samples):
     """
-    Read output files and return a dictionary with
-    the variables for each file.
+    Return the telemetry dict, that stores the counters
+    of the outcomes of each run, the histograms of the
+    runtime of each version and the worst diffs.
     """
 
-    output_data = {}
-    #Common prefix for all the outputs
-    common = folders['tmp'] + folders['f_prefix']
-    #Create dictionary for each output of class
-    for k in gv.X_VARS.keys():
-        try:
-            out = common + v + '_' + k + '.dat'
-            output_data[k] = read_output_file(out, k)
-        except:
-            pass
+    telemetry = {}
+    telemetry['start'] = time.time()
+    telemetry['target'] = n_samples
+    telemetry['completed'] = 0
+    telemetry['outcomes'] = {'success': 0, 'one_sided': 0, 'double_failure': 0}
+    telemetry['runtime'] = {}
+    telemetry['worst_diff'] = {}
+    telemetry['identical'] = {}
 
-    return output_data
+    return telemetry
 
 
-def read_output_file(path, loc):
+def record_attempt(telemetry, output, runtimes):
     """
-    Given the path of a file read the necessary columns
-    and store the values in a dictionary
+    Update the telemetry with the outcome of a run (output is
+    the number of versions that generated output, as in
+    has_output) and with the runtime of each version.
     """
 
-    #Define dict that contains the output
-    output_data = {}
-    #Get headers
-    headers = get_headers(path, loc)
-    #Get content
-    content = np.genfromtxt(path).transpose()
-    #Create dictionaries with keys that are both in the
-    #output and X_VARS or Y_VARS
-    for h in gv.X_VARS[loc]:
-        col = headers.index(h)
-        output_data[h] = content[col]
-    for h in gv.Y_VARS[loc]:
-        try:
-            col = headers.index(h)
-            output_data[h] = content[col]
-        except:
-            pass
-
-    return output_data
+    if output is 2:
+        telemetry['outcomes']['success'] += 1
+    elif output is 1:
+        telemetry['outcomes']['one_sided'] += 1
+    else:
+        telemetry['outcomes']['double_failure'] += 1
+
+    for v in runtimes.keys():
+        if v not in telemetry['runtime']:
+            telemetry['runtime'][v] = {
+                'buckets': [0]*len(gv.RUNTIME_BUCKETS),
+                'sum': 0.,
+                'count': 0
+            }
+        hist = telemetry['runtime'][v]
+        for n, le in enumerate(gv.RUNTIME_BUCKETS):
+            if runtimes[v] <= le:
+                hist['buckets'][n] += 1
+        hist['sum'] += runtimes[v]
+        hist['count'] += 1
+
+    return telemetry
+
+
+def record_sample(telemetry, step, output_diff, identical=None):
+    """
+    Update the telemetry at the end of a sample, with the
+    worst diff of each column of the output table and the
+    files that were bit-identical.
+    """
 
-def get_headers(path, loc):
+    if identical is None:
+        identical = []
+
+    telemetry['completed'] = step
+    for f in identical:
+        telemetry['identical'][f] = telemetry['identical'].get(f, 0) + 1
+    for f in output_diff.keys():
+        if 'input_params' in f:
+            continue
+        for k in output_diff[f].keys():
+            if not output_diff[f][k]:
+                continue
+            col = f + ':' + k
+            val = output_diff[f][k][-1]
+            if np.isnan(val):
+                continue
+            if col not in telemetry['worst_diff'] \
+                or val > telemetry['worst_diff'][col]:
+                telemetry['worst_diff'][col] = val
+
+    return telemetry
+
+
+def print_identical(telemetry):
     """
-    Given a file path, get the headers of that file
+    Print the number of samples with bit-identical
+    output for each file.
     """
 
-    with open(path, 'r') as f:
-        headers = f.read().splitlines()
-    headers = [x for x in headers if x[0] == '#']
-    headers = headers[-1]
-    headers = re.sub('#','',headers)
-    headers = re.split('\d+:', headers)
-    headers = [x.strip() for x in headers]
-    headers = [x for x in headers if x !='']
-    try:
-        headers = [sub_dict(x, gv.DICTIONARY[loc]) for x in headers]
-    except:
-        pass
+    for f in sorted(telemetry['identical'].keys()):
+        print '----> ' + f + ': ' + str(telemetry['identical'][f]) + ' of ' \
+            + str(telemetry['completed']) + ' samples bit-identical'
+    sys.stdout.flush()
 
-    return headers
+    return
 
 
-def sub_dict(txt, rules):
+def telemetry_status(telemetry):
     """
-    Given a string, substitute the rules contained
-    in dict.
+    Return a dict with the current status of the run
+    (counters, throughput, failure rate, ETA, mean runtimes
+    and worst diffs), ready to be dumped in json.
     """
 
-    rep = dict((re.escape(k), v) for k, v in rules.iteritems())
-    pattern = re.compile("|".join(rep.keys()))
-    text = pattern.sub(lambda m: rep[re.escape(m.group(0))], txt)
+    status = {}
+    elapsed = time.time() - telemetry['start']
+    attempts = sum(telemetry['outcomes'].values())
+    failures = attempts - telemetry['outcomes']['success']
+
+    status['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    status['elapsed'] = elapsed
+    status['completed'] = telemetry['completed']
+    status['target'] = telemetry['target']
+    status['outcomes'] = dict(telemetry['outcomes'])
+    status['samples_per_second'] = telemetry['completed']/elapsed
+    if attempts > 0:
+        status['failure_rate'] = float(failures)/attempts
+    else:
+        status['failure_rate'] = 0.
+    if telemetry['completed'] > 0:
+        status['eta'] = (telemetry['target'] - telemetry['completed']) \
+            * elapsed/telemetry['completed']
+    else:
+        status['eta'] = None
+    status['mean_runtime'] = {}
+    for v in telemetry['runtime'].keys():
+        hist = telemetry['runtime'][v]
+        status['mean_runtime'][v] = hist['sum']/max(hist['count'], 1)
+    status['worst_diff'] = dict(telemetry['worst_diff'])
+    status['identical'] = dict(telemetry['identical'])
 
-    return text
+    return status
 
 
-def get_output_diff_struct(params, output_data):
+def telemetry_prometheus(telemetry):
     """
-    Return a dictionary with the same structure
-    of output_data[v]
+    Return the telemetry in the Prometheus text format.
     """
 
-    #Initialize dict
-    output_diff = {}
+    status = telemetry_status(telemetry)
+    lines = []
+
+    lines.append('# TYPE compare_class_runs_total counter')
+    for k in sorted(status['outcomes'].keys()):
+        lines.append('compare_class_runs_total{outcome="%s"} %d'
+            % (k, status['outcomes'][k]))
+
+    lines.append('# TYPE compare_class_samples_completed gauge')
+    lines.append('compare_class_samples_completed %d' % status['completed'])
+    lines.append('# TYPE compare_class_samples_target gauge')
+    lines.append('compare_class_samples_target %d' % status['target'])
+    lines.append('# TYPE compare_class_samples_per_second gauge')
+    lines.append('compare_class_samples_per_second %.6e'
+        % status['samples_per_second'])
+    lines.append('# TYPE compare_class_eta_seconds gauge')
+    if status['eta'] is not None:
+        lines.append('compare_class_eta_seconds %.6e' % status['eta'])
+
+    lines.append('# TYPE compare_class_runtime_seconds histogram')
+    for v in sorted(telemetry['runtime'].keys()):
+        hist = telemetry['runtime'][v]
+        for n, le in enumerate(gv.RUNTIME_BUCKETS):
+            lines.append('compare_class_runtime_seconds_bucket'
+                '{version="%s",le="%g"} %d' % (v, le, hist['buckets'][n]))
+        lines.append('compare_class_runtime_seconds_bucket'
+            '{version="%s",le="+Inf"} %d' % (v, hist['count']))
+        lines.append('compare_class_runtime_seconds_sum{version="%s"} %.6e'
+            % (v, hist['sum']))
+        lines.append('compare_class_runtime_seconds_count{version="%s"} %d'
+            % (v, hist['count']))
+
+    lines.append('# TYPE compare_class_identical_total counter')
+    for f in sorted(status['identical'].keys()):
+        lines.append('compare_class_identical_total{file="%s"} %d'
+            % (f, status['identical'][f]))
+
+    lines.append('# TYPE compare_class_worst_diff gauge')
+    for col in sorted(status['worst_diff'].keys()):
+        lines.append('compare_class_worst_diff{column="%s"} %.6e'
+            % (col, status['worst_diff'][col]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_telemetry(telemetry, folders, metrics_file=None):
+    """
+    Rewrite the json status file in the output folder and,
+    if requested, the Prometheus metrics file. Both files
+    are written atomically.
+    """
 
-    #Create input keys
-    output_diff['input_params'] = {}
-    for var in params['var'].keys():
-        output_diff['input_params'][var] = []
+    #Snapshot of the telemetry, also served by serve_telemetry
+    telemetry['snapshot'] = {
+        'status': json.dumps(telemetry_status(telemetry), indent=2,
+            sort_keys=True),
+        'metrics': telemetry_prometheus(telemetry)
+    }
 
-    #Create output keys
-    for k in output_data['v1'].keys():
-        output_diff[k] = {}
-        for var in output_data['v1'][k].keys():
-            if var in gv.Y_VARS[k]:
-                output_diff[k][var] = []
+    fname = folders['main'] + folders['f_prefix'] + 'status.json'
+    with atomic_open(fname) as f:
+        f.write(telemetry['snapshot']['status'])
 
+    if metrics_file:
+        with atomic_open(metrics_file) as f:
+            f.write(telemetry['snapshot']['metrics'])
 
-    return output_diff
+    return fname
 
 
-def compare_output(params, output_data, output_diff, mode='all'):
+def serve_telemetry(telemetry, port):
     """
-    Given the ref output return the dictionary
-    with the max percentage diff for each
-    dependent variable
+    Serve the telemetry on localhost in a background thread,
+    in Prometheus text format on /metrics and in json on /status.
+    The last snapshot taken by write_telemetry is served, so that
+    the main thread is the only one reading the counters.
     """
 
-    #Define list of files
-    files = output_data['v1'].keys()
-    #Iterate over the various files
-    for f in files:
-        #Define dependent keys for each file
-        keys = output_data['v1'][f].keys()
-        keys = [x for x in keys if x in gv.Y_VARS[f]]
-        for k in keys:
-            #Calculate max percentage diff
-            if mode is 'all':
-                #Try to calculate the percentage diff with ref,
-                #otherwise the ref differences are not subtracted.
-                try:
-                    diff = max_percentage_diff(
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][k],
-                    output_data['v2'][f][gv.X_VARS[f]],
-                    output_data['v2'][f][k],
-                    output_data['ref_v1'][f][gv.X_VARS[f]],
-                    output_data['ref_v1'][f][k],
-                    output_data['ref_v2'][f][gv.X_VARS[f]],
-                    output_data['ref_v2'][f][k]
-                    )
-                except:
-                    diff = max_percentage_diff(
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][k],
-                    output_data['v2'][f][gv.X_VARS[f]],
-                    output_data['v2'][f][k],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]]
-                    )
-            elif mode is 'ref':
-                #Try to calculate the percentage diff of ref,
-                #otherwise error.
-                try:
-                    diff = max_percentage_diff(
-                    output_data['ref_v1'][f][gv.X_VARS[f]],
-                    output_data['ref_v1'][f][k],
-                    output_data['ref_v2'][f][gv.X_VARS[f]],
-                    output_data['ref_v2'][f][k],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]],
-                    output_data['v1'][f][gv.X_VARS[f]]
-                    )
-                except:
-                    raise IOError('--------> Reference model not found!')
+    import BaseHTTPServer
 
-            #Assign output value to dict
-            output_diff[f][k].append(diff)
+    class TelemetryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
-    #Assign input values to dict
-    for k in params['var'].keys():
-        output_diff['input_params'][k].append(params['v1'][k])
+        def do_GET(self):
+            snapshot = telemetry.get('snapshot', {})
+            if self.path.startswith('/metrics'):
+                body = snapshot.get('metrics', '')
+                ctype = 'text/plain; version=0.0.4'
+            elif self.path.startswith('/status'):
+                body = snapshot.get('status', '{}')
+                ctype = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.end_headers()
+            self.wfile.write(body)
 
-    return output_diff
+        def log_message(self, *args):
+            return
+
+    server = BaseHTTPServer.HTTPServer(('localhost', port), TelemetryHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
 
+    return server
 
-def max_percentage_diff(x1, y1, x2, y2, ref_x1, ref_y1, ref_x2, ref_y2):
+
+def file_type(name):
     """
-    Return the max percentage diff.
-    If there is a reference model,
-    subtract its percentage diffs.
+    Return the type of the output file name
+    (see FILE_TYPES), or None if it is unknown.
     """
 
-    #Compute the minimum and maximum values of x
-    xmin = max(min(x1),min(x2),min(ref_x1),min(ref_x2))
-    xmax = min(max(x1),max(x2),max(ref_x1),max(ref_x2))
+    for (ftype, patterns) in gv.FILE_TYPES:
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return ftype
 
-    #Interpolate linearly for all the data
-    data1 = interpolate.interp1d(x1,y1)
-    data2 = interpolate.interp1d(x2,y2)
-    ref_data1 = interpolate.interp1d(ref_x1,ref_y1)
-    ref_data2 = interpolate.interp1d(ref_x2,ref_y2)
+    return None
 
-    #Initialise max_diff to 0.
-    max_diff = 0.
-    #Calculate the relative difference
-    therange = [x for x in x1 if xmin<=x<=xmax]
-    for x in therange:
-        #Try to avoid numerical divergences
-        if data1(x) == 0. and data2(x) == 0.:
-            diff = 0.
-        else:
-            diff = data2(x)/data1(x)-1.
-        if ref_data1(x) == 0. and ref_data2(x) == 0.:
-            ref_diff = 0.
-        else:
-            ref_diff = ref_data2(x)/ref_data1(x)-1.
-        #Total diff
-        tot_diff = 100.*np.fabs(diff-ref_diff)
-        #Store max value
-        if tot_diff > max_diff:
-            max_diff = tot_diff
+
+def list_output_files(folders, v):
+    """
+    Return a dict with the name (e.g. 'cl', 'z2_pk') and the path
+    of each output file of known type generated by the version v
+    of class. Files of unknown type are reported.
+    """
+
+    prefix = folders['f_prefix'] + v + '_'
+    files = {}
+    for fname in fnmatch.filter(os.listdir(folders['tmp']), prefix + '*.dat'):
+        name = fname[len(prefix):-len('.dat')]
+        if file_type(name):
+            files[name] = folders['tmp'] + fname
+        else:
+            report_once(folders.setdefault('reported', set()),
+                '--------> Unknown type of output file ' + name
+                + '.dat, not compared (see FILE_TYPES)')
+
+    return files
+
+
+def report_once(reported, message):
+    """
+    Print a message, only the first time it is reported.
+    reported is the set of the messages already reported.
+    """
+
+    if message not in reported:
+        reported.add(message)
+        print message
+        sys.stdout.flush()
+
+    return
+
+
+def parse_output_file(job):
+    """
+    Parse an output file, given job = (name, path, raw)
+    where raw is the content of the file (or None). Return
+    the parsed data, or None if the file is unparsable.
+    """
+
+    (name, path, raw) = job
+    try:
+        return read_output_file(path, file_type(name), raw)
+    except Exception as e:
+        print '--------> Unable to read ' + os.path.relpath(path) + ': ' \
+            + str(e)
+        sys.stdout.flush()
+        return None
+
+
+def parse_output_files(jobs):
+    """
+    Parse in parallel the output files in the list
+    of jobs (see parse_output_file) and return the
+    list of the parsed data.
+    """
+
+    from multiprocessing.pool import ThreadPool
+
+    if len(jobs) < 2:
+        return [parse_output_file(job) for job in jobs]
+    pool = ThreadPool(min(len(jobs), gv.READ_THREADS))
+    data = pool.map(parse_output_file, jobs)
+    pool.close()
+    pool.join()
+
+    return data
+
+
+def read_output(folders, v):
+    """
+    Read output files and return a dictionary with
+    the variables for each file.
+    """
+
+    files = list_output_files(folders, v)
+    jobs = [(k, files[k], None) for k in sorted(files.keys())]
+    data = parse_output_files(jobs)
+    output_data = dict((job[0], d) for (job, d) in zip(jobs, data)
+        if d is not None)
+
+    return output_data
+
+
+def paired_output_files(folders, versions):
+    """
+    Return a dict with the output files of each of the two
+    versions (see list_output_files) and the sorted list of
+    the names of the files generated by both. The files
+    generated by one version only are reported.
+    """
+
+    (v1, v2) = versions
+    files = dict((v, list_output_files(folders, v)) for v in versions)
+    for k in sorted(set(files[v1].keys()) ^ set(files[v2].keys())):
+        missing = v2 if k in files[v1] else v1
+        print '--------> Output file ' + k + '.dat missing for ' + missing \
+            + ', not compared'
+    names = sorted(set(files[v1].keys()) & set(files[v2].keys()))
+
+    return files, names
+
+
+def read_output_pair(folders, versions=None):
+    """
+    Read the output files of two versions of class and return
+    a dictionary with the variables of each file for both, and
+    the list of the files that are bit-identical. Each file is
+    hashed while it is read: if the file of the second version
+    is identical to the one of the first, it is not parsed
+    again and the arrays of the first version are reused.
+    """
+
+    if versions is None:
+        versions = ['v1', 'v2']
+    (v1, v2) = versions
+    output_data = {v1: {}, v2: {}}
+    files, names = paired_output_files(folders, versions)
+
+    #Read and hash the files, and parse them in parallel
+    jobs = []
+    same = []
+    for k in names:
+        raw = {}
+        for v in versions:
+            with open(files[v][k], 'rb') as f:
+                raw[v] = f.read()
+        jobs.append((k, files[v1][k], raw[v1]))
+        if hashlib.sha1(raw[v1]).digest() == hashlib.sha1(raw[v2]).digest():
+            same.append(k)
+        else:
+            jobs.append((k, files[v2][k], raw[v2]))
+    data = parse_output_files(jobs)
+
+    #Identical files are parsed once and share the arrays
+    for (job, d) in zip(jobs, data):
+        v = v1 if job[1] == files[v1][job[0]] else v2
+        if d is not None:
+            output_data[v][job[0]] = d
+    identical = [k for k in same if k in output_data[v1]]
+    for k in identical:
+        output_data[v2][k] = output_data[v1][k]
+    #Only the files parsed for both versions are compared
+    for k in names:
+        if (k in output_data[v1]) != (k in output_data[v2]):
+            output_data[v1].pop(k, None)
+            output_data[v2].pop(k, None)
+
+    return output_data, identical
+
+
+def stream_output_pair(params, folders, ref_data=None, dtype=np.float64,
+    versions=None):
+    """
+    Compare the output files of two versions of class chunk by
+    chunk (see stream_diff), so that the memory does not grow with
+    the size of the files. ref_data is the output of the reference
+    models, if any. Return a dict with the diffs of each file, in
+    the form {file: {'var:metric': value}}, and the list of the files
+    that are bit-identical.
+    """
+
+    if versions is None:
+        versions = ['v1', 'v2']
+    (v1, v2) = versions
+    files, names = paired_output_files(folders, versions)
+    diff = {}
+    identical = []
+    for k in names:
+        paths = (files[v1][k], files[v2][k])
+        try:
+            ref = None
+            if ref_data:
+                ref = (ref_data['ref_v1'].get(k), ref_data['ref_v2'].get(k))
+                ref = None if None in ref else ref
+            #Identical files have 0 diffs, without aligning them
+            if same_files(paths[0], paths[1]):
+                identical.append(k)
+                if ref is None or same_output(ref_data,
+                    ['ref_v1', 'ref_v2'], k):
+                    diff[k] = stream_zero_diff(params, k, paths[0], dtype)
+                    continue
+            diff[k] = stream_diff(params, k, paths, ref, dtype)
+        except Exception as e:
+            print '--------> Unable to read ' + os.path.relpath(paths[0]) \
+                + ' or ' + os.path.relpath(paths[1]) + ': ' + str(e)
+            sys.stdout.flush()
+
+    return diff, identical
+
+
+def same_files(path1, path2):
+    """
+    Return True if two files have the same content,
+    comparing them block by block.
+    """
+
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    with open(path1, 'rb') as f1:
+        with open(path2, 'rb') as f2:
+            while True:
+                block = f1.read(1 << 20)
+                if block != f2.read(1 << 20):
+                    return False
+                if not block:
+                    return True
+
+
+def stream_zero_diff(params, name, path, dtype=np.float64):
+    """
+    Return a dict with the value of each 'var:metric' of the
+    output file (path) of the file name, when the two versions
+    are identical (see zero_metrics), reading it in chunks.
+    """
+
+    loc = file_type(name)
+    metrics = get_metrics(params, name)
+    acc = {}
+    for chunk in read_chunks(path, loc, dtype):
+        x = chunk[gv.X_VARS[loc]]
+        for y in [k for k in chunk.keys() if k != gv.X_VARS[loc]]:
+            if y not in acc:
+                acc[y] = init_metrics(metrics)
+            accumulate_metrics(acc[y], x, np.zeros(len(x)))
+
+    diffs = {}
+    for y in acc.keys():
+        values = metric_values(acc[y])
+        for metric in metrics:
+            diffs[y + ':' + metric] = values[metric]
+
+    return diffs
+
+
+def stream_scales(path, loc, dtype=np.float64):
+    """
+    Return a dict with the scale used to interpolate each
+    variable of the output file (path) of type loc (see
+    sample_curve). For 'log' files, log-log or log-lin is
+    chosen from the signs over the whole file, as when the
+    file is read at once, with a first pass over its chunks.
+    """
+
+    x = gv.X_VARS[loc]
+    scale = gv.X_SCALES.get(loc, 'lin')
+    low = {}
+    if scale == 'log':
+        for chunk in read_chunks(path, loc, dtype):
+            for k in chunk.keys():
+                if len(chunk[k]):
+                    low[k] = min(low.get(k, np.inf), np.min(chunk[k]))
+
+    scales = {}
+    for y in gv.Y_VARS[loc]:
+        if scale != 'log':
+            scales[y] = scale
+        elif low.get(x, 0.) <= 0.:
+            scales[y] = 'lin'
+        elif low.get(y, 0.) > 0.:
+            scales[y] = 'loglog'
+        else:
+            scales[y] = 'loglin'
+
+    return scales
+
+
+def stream_diff(params, name, paths, ref=None, dtype=np.float64):
+    """
+    Compare the output files (paths) of two versions of class
+    of the file name, reading them in chunks. The second curve is
+    read ahead only until it covers the current chunk of the first
+    one, and the points it does not need anymore are dropped. The
+    metrics are accumulated over the chunks. ref is the pair of
+    the reference outputs of the file, if any (kept in memory).
+    The interpolation depends only on the neighbouring points and
+    on the scales of the whole curve (see stream_scales), so that
+    the diffs are the same as when the files are read at once.
+    Return a dict with the value of each 'var:metric'.
+    """
+
+    loc = file_type(name)
+    x = gv.X_VARS[loc]
+    scale = gv.X_SCALES.get(loc, 'lin')
+    scales = stream_scales(paths[1], loc, dtype)
+    metrics = get_metrics(params, name)
+    acc = {}
+    chunks2 = read_chunks(paths[1], loc, dtype)
+    buf = None
+    sign = None
+    done = False
+    for chunk in read_chunks(paths[0], loc, dtype):
+        x1 = chunk[x]
+        #Direction of the grid (e.g. z is decreasing)
+        if sign is None and len(x1) > 1:
+            sign = 1. if x1[-1] >= x1[0] else -1.
+        elif sign is None:
+            sign = 1.
+        if np.any(np.diff(sign*x1) < 0.):
+            raise ValueError('the grid of ' + x + ' is not monotonic')
+        top = np.max(sign*x1)
+        #Read the second curve until it covers the chunk
+        while not done and (buf is None or np.max(sign*buf[x]) < top):
+            try:
+                new = next(chunks2)
+            except StopIteration:
+                done = True
+                break
+            if buf is None:
+                buf = new
+            else:
+                buf = dict((k, np.concatenate([buf[k], new[k]]))
+                    for k in new.keys())
+        if buf is None:
+            break
+        s2 = sign*buf[x]
+        if np.any(np.diff(s2) < 0.):
+            raise ValueError('the grids of ' + x + ' are not aligned')
+
+        #Points in the overlapping range
+        keep = (sign*x1 >= s2[0]) & (sign*x1 <= s2[-1])
+        if ref:
+            for r in ref:
+                keep &= (x1 >= np.min(r[x])) & (x1 <= np.max(r[x]))
+        xs = x1[keep]
+        if len(xs):
+            for y in [k for k in chunk.keys() if k != x and k in buf]:
+                diff = relative_diff(chunk[y][keep],
+                    sample_curve(xs, buf[x], buf[y], scales[y]))
+                if ref:
+                    diff = diff - relative_diff(
+                        sample_curve(xs, ref[0][x], ref[0][y], scale),
+                        sample_curve(xs, ref[1][x], ref[1][y], scale))
+                if y not in acc:
+                    acc[y] = init_metrics(metrics)
+                accumulate_metrics(acc[y], xs, diff)
+        elif done and np.min(sign*x1) > s2[-1]:
+            break
+
+        #Drop the points of the second curve before the last interval
+        i = max(np.searchsorted(s2, top, side='right') - 1, 0)
+        buf = dict((k, buf[k][i:].copy()) for k in buf.keys())
+
+    diffs = {}
+    for y in acc.keys():
+        values = metric_values(acc[y])
+        for metric in metrics:
+            diffs[y + ':' + metric] = values[metric]
+
+    return diffs
+
+
+def read_chunks(path, loc, dtype=np.float64):
+    """
+    Read an output file of type loc in chunks of CHUNK_ROWS
+    rows. Yield, for each chunk, a dict with the arrays of
+    the x and y variables, so that the file is never loaded
+    as a whole.
+    """
+
+    with open(path, 'r') as f:
+        #Headers
+        comments = []
+        line = f.readline()
+        while line and (line.startswith('#') or not line.strip()):
+            if line.startswith('#'):
+                comments.append(line)
+            line = f.readline()
+        headers = get_headers(path, loc, ''.join(comments))
+        cols = [gv.X_VARS[loc]] + [h for h in gv.Y_VARS[loc] if h in headers]
+        usecols = [headers.index(h) for h in cols]
+        #Content
+        rows = [line] if line.strip() else []
+        for line in f:
+            rows.append(line)
+            if len(rows) == gv.CHUNK_ROWS:
+                data = np.loadtxt(rows, dtype=dtype, usecols=usecols, ndmin=2)
+                yield dict((h, data[:, n]) for (n, h) in enumerate(cols))
+                rows = []
+        if rows:
+            data = np.loadtxt(rows, dtype=dtype, usecols=usecols, ndmin=2)
+            yield dict((h, data[:, n]) for (n, h) in enumerate(cols))
+
+
+def append_diff(params, output_diff, diff):
+    """
+    Append to output_diff the diffs of a sample, in the form
+    {file: {'var:metric': value}}, and the values of its varying
+    parameters. The files missing in a sample get nan, as well as
+    the previous samples of the files generated for the first time.
+    """
+
+    if not output_diff:
+        output_diff['input_params'] = dict((k, []) for k in params['var'])
+    rows = count_rows(output_diff)
+    for f in diff.keys():
+        if f not in output_diff:
+            if rows:
+                print '--------> New output file ' + f + '.dat, added to ' \
+                    'the output table'
+            output_diff[f] = dict((k, [np.nan]*rows) for k in diff[f].keys())
+    for f in output_diff.keys():
+        if f != 'input_params':
+            for k in output_diff[f].keys():
+                output_diff[f][k].append(diff.get(f, {}).get(k, np.nan))
+    if params['var']:
+        sample = get_sample(params)
+        for k in params['var'].keys():
+            output_diff['input_params'][k].append(sample[k])
+
+    return output_diff
+
+
+def read_output_file(path, loc, raw=None):
+    """
+    Given the path of a file read the necessary columns
+    and store the values in a dictionary. If the content
+    of the file has already been read, it can be passed as raw.
+    """
+
+    #Define dict that contains the output
+    output_data = {}
+    if raw is None:
+        with open(path, 'r') as f:
+            raw = f.read()
+    #Get headers
+    headers = get_headers(path, loc, raw)
+    #Get content
+    content = np.genfromtxt(StringIO(raw)).transpose()
+    #Create dictionaries with keys that are both in the
+    #output and X_VARS or Y_VARS
+    for h in [gv.X_VARS[loc]]:
+        col = headers.index(h)
+        output_data[h] = content[col]
+    for h in gv.Y_VARS[loc]:
+        if h in headers:
+            col = headers.index(h)
+            output_data[h] = content[col]
+
+    return output_data
+
+def get_headers(path, loc, raw=None):
+    """
+    Given a file path (or its content), get the
+    headers of that file
+    """
+
+    if raw is None:
+        with open(path, 'r') as f:
+            raw = f.read()
+    headers = raw.splitlines()
+    headers = [x for x in headers if x[0] == '#']
+    headers = headers[-1]
+    headers = re.sub('#','',headers)
+    headers = re.split('\d+:', headers)
+    headers = [x.strip() for x in headers]
+    headers = [x for x in headers if x !='']
+    if loc in gv.DICTIONARY:
+        headers = [sub_dict(x, gv.DICTIONARY[loc]) for x in headers]
+
+    return headers
+
+
+def sub_dict(txt, rules):
+    """
+    Given a string, substitute the rules contained
+    in dict.
+    """
+
+    rep = dict((re.escape(k), v) for k, v in rules.iteritems())
+    pattern = re.compile("|".join(rep.keys()))
+    text = pattern.sub(lambda m: rep[re.escape(m.group(0))], txt)
+
+    return text
+
+
+def bank_fingerprint(params):
+    """
+    Return a dict with the sha1 fingerprints of the parameters
+    that determine the output of class_v1: the fixed parameters
+    of 'v1' (and 'ref_v1') and the ranges of the varying ones.
+    """
+
+    fingerprint = {}
+    for v in ['v1', 'ref_v1', 'var']:
+        if v in params:
+            #Skip the root and the keys grouped by group_parameters
+            keys = [k for k in sorted(params[v].keys())
+                if k != 'root' and k + '__1' not in params[v]]
+            lines = [k + ' = ' + str(params[v][k]) for k in keys]
+            if v == 'var':
+                lines += [k + ' = derived: ' + params['derived'][k]
+                    for k in sorted(params.get('derived', {}).keys())]
+            fingerprint[v] = hashlib.sha1('\n'.join(lines)).hexdigest()
+        else:
+            fingerprint[v] = 'None'
+
+    return fingerprint
+
+
+def write_bank(path, bank):
+    """
+    Write the bank in the folder path. The arrays of each
+    column of each file are concatenated over the samples
+    and stored as .npy files, so that they can be memory
+    mapped when read.
+    """
+
+    path = folder_exists_or(path, mod='create')
+
+    #Fingerprints and general info
+    with atomic_open(path + 'fingerprint.ini') as f:
+        for k in sorted(bank['fingerprint'].keys()):
+            f.write(k + ' = ' + str(bank['fingerprint'][k]) + '\n')
+
+    #Samples of the varying parameters
+    header = ''
+    for n, var in enumerate(bank['var']):
+        header = header + str(n+1) + ':' + var + '    '
+    with atomic_open(path + 'samples.dat') as f:
+        np.savetxt(f, np.array(bank['samples'], ndmin=2),
+            header=header, delimiter='    ', fmt='%.18e')
+
+    #Output of each sample
+    files = set()
+    for data in bank['output']:
+        files.update(data.keys())
+    for f in files:
+        cols = set()
+        for data in bank['output']:
+            if f in data:
+                cols.update(data[f].keys())
+        offsets = [0]
+        for data in bank['output']:
+            if f in data:
+                x = gv.X_VARS[file_type(f)]
+                offsets.append(offsets[-1] + len(data[f][x]))
+            else:
+                offsets.append(offsets[-1])
+        with atomic_open(path + f + '.offsets.npy', 'wb') as fn:
+            np.save(fn, np.array(offsets, dtype=np.int64))
+        for col in cols:
+            array = [data[f][col] for data in bank['output']
+                if f in data and col in data[f]]
+            with atomic_open(path + f + '.' + col + '.npy', 'wb') as fn:
+                np.save(fn, np.concatenate(array))
+
+    #Output of the reference model
+    if bank['ref']:
+        for f in bank['ref'].keys():
+            for col in bank['ref'][f].keys():
+                with atomic_open(path + 'ref.' + f + '.' + col + '.npy',
+                    'wb') as fn:
+                    np.save(fn, bank['ref'][f][col])
+
+    return path
+
+
+def read_bank(path):
+    """
+    Read a bank written by write_bank. The arrays are
+    memory mapped and not loaded in memory.
+    """
+
+    path = folder_exists_or(path, mod='error')
+    bank = {}
+
+    #Fingerprints
+    try:
+        bank['fingerprint'] = read_ini_file(path + 'fingerprint.ini')
+    except IOError:
+        raise IOError('--------> No bank found in ' + path)
+
+    #Samples
+    with open(path + 'samples.dat', 'r') as f:
+        header = f.readline()
+    header = re.split('\d+:', header.strip('#').strip())
+    bank['var'] = [x.strip() for x in header if x.strip() != '']
+    bank['samples'] = np.loadtxt(path + 'samples.dat', ndmin=2)
+
+    #Output of the samples and of the reference model
+    bank['offsets'] = {}
+    bank['arrays'] = {}
+    bank['ref'] = {}
+    for fname in glob.glob(path + '*.npy'):
+        name = os.path.basename(fname)[:-len('.npy')].split('.')
+        array = np.load(fname, mmap_mode='r')
+        if name[0] == 'ref':
+            bank['ref'].setdefault(name[1], {})[name[2]] = array
+        elif name[1] == 'offsets':
+            bank['offsets'][name[0]] = array
+        else:
+            bank['arrays'].setdefault(name[0], {})[name[1]] = array
+
+    return bank
+
+
+def check_bank_fingerprint(bank, params):
+    """
+    Raise an error if the parameters of class_v1
+    do not match the ones used to generate the bank.
+    """
+
+    fingerprint = bank_fingerprint(params)
+    for k in fingerprint.keys():
+        if fingerprint[k] != bank['fingerprint'][k]:
+            raise IOError('--------> The ' + k + ' parameters do not match '
+                'the ones of the bank!')
+
+    return
+
+
+def assign_bank_sample(params, bank, n):
+    """
+    Return the params dict with the values of
+    the varying parameters of sample n of the bank.
+    """
+
+    sample = dict(zip(bank['var'], bank['samples'][n]))
+
+    return assign_sample(params, sample)
+
+
+def read_bank_output(bank, n):
+    """
+    Return a dictionary with the output of sample n
+    of the bank, with the same structure of read_output.
+    """
+
+    output_data = {}
+    for f in bank['arrays'].keys():
+        start = bank['offsets'][f][n]
+        end = bank['offsets'][f][n+1]
+        if end > start:
+            output_data[f] = {}
+            for col in bank['arrays'][f].keys():
+                output_data[f][col] = bank['arrays'][f][col][start:end]
+
+    return output_data
+
+
+def archive_sample(batch, step, params, output_data):
+    """
+    Add to the batch dict the input parameters and the
+    output of v1 and v2 of the current sample, with keys
+    '<step>.input.<param>' and '<step>.<v>.<file>.<var>'.
+    """
+
+    sample = get_sample(params)
+    for k in sample.keys():
+        batch[str(step) + '.input.' + k] = np.array(sample[k])
+    for v in ['v1', 'v2']:
+        for f in output_data[v].keys():
+            for col in output_data[v][f].keys():
+                key = '.'.join([str(step), v, f, col])
+                batch[key] = np.asarray(output_data[v][f][col])
+
+    return batch
+
+
+def write_archive_shard(batch, folders, n):
+    """
+    Write the batch of samples in the compressed shard n
+    of the archive and empty the batch.
+    """
+
+    fname = folders['archive'] + folders['f_prefix'] + 'shard_%04d.npz' % n
+    with atomic_open(fname, 'wb') as f:
+        np.savez_compressed(f, **batch)
+    batch.clear()
+
+    return fname
+
+
+def write_archive_ref(output_data, folders):
+    """
+    Write the output of the reference models in the archive.
+    """
+
+    ref = {}
+    for v in ['ref_v1', 'ref_v2']:
+        for f in output_data[v].keys():
+            for col in output_data[v][f].keys():
+                ref['.'.join([v, f, col])] = output_data[v][f][col]
+    with atomic_open(folders['archive'] + 'ref.npz', 'wb') as f:
+        np.savez_compressed(f, **ref)
+
+    return
+
+
+def read_archive_file(fname):
+    """
+    Read a shard (or the ref file) of the archive and return
+    a dictionary with the same nesting of the keys.
+    """
+
+    data = {}
+    with np.load(fname) as npz:
+        for key in npz.files:
+            d = data
+            key_list = key.split('.')
+            for k in key_list[:-1]:
+                d = d.setdefault(k, {})
+            d[key_list[-1]] = npz[key]
+
+    return data
+
+
+def select_variables(output_data, variables):
+    """
+    Return a copy of output_data only with the requested
+    variables (in the form file:var) and their x variable.
+    """
+
+    new_data = {}
+    for var in variables:
+        (f, k) = var.split(':')
+        if f in output_data and k in output_data[f]:
+            new_data.setdefault(f, {})[k] = output_data[f][k]
+            x = gv.X_VARS[file_type(f)]
+            new_data[f][x] = output_data[f][x]
+
+    return new_data
+
+
+def rediff_shard(job):
+    """
+    Recompute the diffs of all the samples of an archive
+    shard. job is a tuple with the path of the shard, the
+    ref output (or None), the variables to compare (or None)
+    the x ranges and the metrics. Return a list of output_diff
+    dicts, one per sample, sorted by step.
+    """
+
+    (fname, ref, variables, x_range, metrics) = job
+    shard = read_archive_file(fname)
+
+    diffs = []
+    for step in sorted(shard.keys(), key=int):
+        #Output data of the sample
+        output_data = {}
+        for v in ['v1', 'v2']:
+            output_data[v] = shard[step][v]
+            if variables:
+                output_data[v] = select_variables(output_data[v], variables)
+        if ref:
+            output_data.update(ref)
+        #Input parameters of the sample
+        params = {}
+        params['var'] = shard[step].get('input', {})
+        names = sorted(params['var'].keys())
+        params['space'] = {'names': names, 'n_var': len(names),
+            'vector': np.array([float(params['var'][k]) for k in names])}
+        params['metrics'] = metrics
+        #Compare
+        output_diff = get_output_diff_struct(params, output_data)
+        compare_output(params, output_data, output_diff, x_range=x_range)
+        diffs.append((int(step), output_diff))
+
+    return diffs
+
+
+def merge_output_diff(output_diff, new):
+    """
+    Append the values of the output_diff dict new
+    to the ones of output_diff. The files (or columns)
+    missing in one of the two get nan for its samples,
+    as in compare_output.
+    """
+
+    rows = count_rows(output_diff)
+    for f in new.keys():
+        output_diff.setdefault(f, {})
+        for k in new[f].keys():
+            output_diff[f].setdefault(k, [np.nan]*rows)
+            output_diff[f][k].extend(new[f][k])
+    pad_output_diff(output_diff, rows + count_rows(new))
+
+    return output_diff
+
+
+def count_rows(output_diff):
+    """
+    Return the number of samples in output_diff,
+    i.e. the length of its longest column.
+    """
+
+    return max([len(col) for f in output_diff.values()
+        for col in f.values()] + [0])
+
+
+def pad_output_diff(output_diff, rows):
+    """
+    Pad with nan the columns of output_diff shorter
+    than rows (the files missing in some samples).
+    """
+
+    for f in output_diff.keys():
+        if f != 'input_params':
+            for col in output_diff[f].values():
+                col.extend([np.nan]*(rows - len(col)))
+
+    return output_diff
+
+
+def read_metrics(params):
+    """
+    Extract from the 'common' params the metrics declared
+    in the ini file, in the form
+    metrics_<file> = max, rms, chi2, max[2,30]
+    and store them in params['metrics'].
+    """
+
+    params['metrics'] = {}
+    for key in params['common'].keys():
+        if key.startswith('metrics_'):
+            val = params['common'].pop(key)
+            metrics = re.findall('\w+(?:\[[^\]]*\])?', val)
+            params['metrics'][key[len('metrics_'):]] = metrics
+
+    return params
+
+
+def get_metrics(params, f):
+    """
+    Return the list of metrics for the file f, from the
+    ini file if declared there (for the file or for its
+    type), otherwise from METRICS.
+    """
+
+    for k in [f, file_type(f)]:
+        if k in params.get('metrics', {}):
+            return params['metrics'][k]
+
+    return gv.METRICS.get(file_type(f), ['max'])
+
+
+def parse_metric(metric):
+    """
+    Split a metric in the form name or name[xmin,xmax]
+    into its name and window (None if not present).
+    """
+
+    match = re.match('(\w+)(?:\[([^,]+),([^\]]+)\])?$', metric.strip())
+    if not match or match.group(1) not in ['max', 'rms', 'chi2']:
+        raise IOError('--------> Unknown metric ' + metric)
+    if match.group(2):
+        window = (float(match.group(2)), float(match.group(3)))
+    else:
+        window = None
+
+    return match.group(1), window
+
+
+def init_queue(path, config):
+    """
+    Create the folders of the job queue (pending/, claimed/
+    and results/), removing the leftovers of previous queues,
+    and write the configuration read by the workers.
+    """
+
+    path = folder_exists_or(path, mod='create')
+    for sub in ['pending', 'claimed', 'results']:
+        shutil.rmtree(path + sub, ignore_errors=True)
+        os.mkdir(path + sub)
+    if os.path.exists(path + 'stop'):
+        os.remove(path + 'stop')
+    with atomic_open(path + 'config.json') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+    return path
+
+
+def get_sample(params):
+    """
+    Return a dict with the current values of the varying parameters.
+    """
+
+    space = params['space']
+    n_var = space['n_var']
+
+    return dict(zip(space['names'][:n_var], space['vector'][:n_var].tolist()))
+
+
+def assign_sample(params, sample):
+    """
+    Return the params dict with the values of
+    the varying parameters stored in sample.
+    """
+
+    space = params['space']
+    fill_vector(space, sample, space['vector'])
+
+    return params
+
+
+def fill_vector(space, sample, vector):
+    """
+    Fill the vector with the values of the varying
+    parameters stored in sample and the derived ones.
+    """
+
+    for (i, k) in enumerate(space['names'][:space['n_var']]):
+        vector[i] = float(sample[k])
+
+    return compute_derived(space, vector)
+
+
+def post_job(path, job_id, sample, runtime=0.):
+    """
+    Add a job with the given sample to the queue. Jobs are claimed
+    by decreasing expected runtime (if given), then by id.
+    """
+
+    rank = 10**12 - 1 - min(int(runtime*1000.), 10**12 - 1)
+    fname = path + 'pending/' + '%012d_%08d' % (rank, job_id) + '.json'
+    with atomic_open(fname) as f:
+        json.dump({'id': job_id, 'sample': sample}, f)
+
+    return fname
+
+
+def claim_job(path, worker_id):
+    """
+    Claim the first pending job, moving it atomically to claimed/.
+    Return the job and the path of the claimed file, or (None, None)
+    if there are no pending jobs.
+    """
+
+    for fname in sorted(os.listdir(path + 'pending/')):
+        claimed = path + 'claimed/' + fname + '.' + worker_id
+        try:
+            os.rename(path + 'pending/' + fname, claimed)
+            #Start the heartbeat from the time of the claim
+            os.utime(claimed, None)
+            with open(claimed, 'r') as f:
+                job = json.load(f)
+        except (OSError, IOError):
+            #Another worker was faster
+            continue
+        return job, claimed
+
+    return None, None
+
+
+def start_heartbeat(fname):
+    """
+    Update the time stamp of fname every QUEUE_HEARTBEAT seconds
+    in a background thread, to show that the job is alive.
+    Return an Event that stops the heartbeat when set.
+    """
+
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(gv.QUEUE_HEARTBEAT):
+            try:
+                os.utime(fname, None)
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+
+    return stop
+
+
+def post_result(path, job, result, claimed):
+    """
+    Write the result of a job in results/ and release its claim.
+    """
+
+    fname = path + 'results/' + '%08d' % job['id'] + '.json'
+    result['id'] = job['id']
+    result['sample'] = job['sample']
+    with atomic_open(fname) as f:
+        json.dump(result, f)
+    try:
+        os.remove(claimed)
+    except OSError:
+        #The job has been put back in the queue in the meantime
+        pass
+
+    return fname
+
+
+def output_diff_to_result(output_diff):
+    """
+    Convert the output_diff dict of a single sample into
+    a dict of floats that can be dumped in json.
+    """
+
+    result = {}
+    for f in output_diff.keys():
+        if 'input_params' in f:
+            continue
+        result[f] = {}
+        for k in output_diff[f].keys():
+            result[f][k] = float(output_diff[f][k][-1])
+
+    return result
+
+
+def result_to_output_diff(result):
+    """
+    Convert the result of a job into an output_diff
+    dict with a single sample.
+    """
+
+    output_diff = {}
+    output_diff['input_params'] = dict((k, [result['sample'][k]])
+        for k in result['sample'].keys())
+    for f in result['diff'].keys():
+        output_diff[f] = dict((k, [result['diff'][f][k]])
+            for k in result['diff'][f].keys())
+
+    return output_diff
+
+
+def collect_results(path):
+    """
+    Read and remove the results posted by the workers.
+    Return a list of results, sorted by job id.
+    """
+
+    results = []
+    for fname in sorted(os.listdir(path + 'results/')):
+        if not fname.endswith('.json'):
+            continue
+        with open(path + 'results/' + fname, 'r') as f:
+            results.append(json.load(f))
+        os.remove(path + 'results/' + fname)
+
+    return results
+
+
+def requeue_stale_jobs(path, timeout):
+    """
+    Put back in the queue the claimed jobs whose heartbeat
+    is older than timeout seconds (i.e. the worker died).
+    Return the number of jobs put back in the queue.
+    """
+
+    count = 0
+    for fname in os.listdir(path + 'claimed/'):
+        claimed = path + 'claimed/' + fname
+        try:
+            age = time.time() - os.path.getmtime(claimed)
+        except OSError:
+            continue
+        if age > timeout:
+            job = fname.split('.json')[0] + '.json'
+            try:
+                os.rename(claimed, path + 'pending/' + job)
+                count += 1
+            except OSError:
+                pass
+
+    return count
+
+
+def parse_numeric(val):
+    """
+    Return a list of floats if val is a comma separated
+    list of numbers, otherwise None.
+    """
+
+    try:
+        return [float(x) for x in str(val).split(',')]
+    except ValueError:
+        return None
+
+
+def boundary_dims(inis, good):
+    """
+    Return the dimensions of the parameter space where the
+    failing samples (inis, with keys 'v1' and 'v2') differ from
+    the good one, as a list of (key, index, good value, failing
+    value). Only the numeric parameters that have the same
+    value for v1 and v2 (i.e. the sampled ones) are considered.
+    """
+
+    dims = []
+    for key in sorted(inis['v1'].keys()):
+        if key == 'root' or key not in inis['v2'] or key not in good:
+            continue
+        val1 = parse_numeric(inis['v1'][key])
+        val2 = parse_numeric(inis['v2'][key])
+        val_good = parse_numeric(good[key])
+        if val1 is None or val1 != val2 or val_good is None \
+            or len(val_good) != len(val1):
+            continue
+        for n in range(len(val1)):
+            if val1[n] != val_good[n]:
+                dims.append((key, n, val_good[n], val1[n]))
+
+    return dims
+
+
+def probe_inis(inis, dims, t, reset=None):
+    """
+    Return the ini dicts of the probe at position t along the
+    segment from the good sample (t=0) to the failing one (t=1),
+    moving only the dimensions in dims and not in reset.
+    """
+
+    if reset is None:
+        reset = []
+
+    probe = {}
+    for v in ['v1', 'v2']:
+        probe[v] = dict(inis[v])
+    for (n, (key, i, val_good, val_fail)) in enumerate(dims):
+        if n in reset:
+            val = val_good
+        else:
+            val = val_good + t*(val_fail - val_good)
+        for v in ['v1', 'v2']:
+            vals = parse_numeric(probe[v][key])
+            vals[i] = val
+            probe[v][key] = ','.join(repr(x) for x in vals)
+
+    return probe
+
+
+def run_probe(folders, inis):
+    """
+    Run the two versions of class on the ini dicts in inis
+    (keys 'v1' and 'v2'), in a new workspace. Return the
+    number of versions that generated output.
+    """
+
+    probe_folders = dict(folders)
+    probe_folders['tmp'] = create_workspace(folders)
+    root = os.path.relpath(probe_folders['tmp']) + '/' + folders['f_prefix']
+    output = 0
+    try:
+        for v in ['v1', 'v2']:
+            params = dict(inis[v])
+            params['root'] = root + v + '_'
+            create_ini_file(params, probe_folders, v)
+            run_class(probe_folders, v)
+            output = has_output(probe_folders, v, output)
+    finally:
+        release_workspace(probe_folders['tmp'])
+
+    return output
+
+
+def run_probes(folders, probes, processes):
+    """
+    Run in parallel the probes (list of ini dicts) and
+    return the list of outputs (see run_probe).
+    """
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(processes)
+    outputs = pool.map(lambda x: run_probe(folders, x), probes)
+    pool.close()
+    pool.join()
+
+    return outputs
+
+
+def write_ini_dict(params, fname):
+    """
+    Write an ini file from a dict of parameters.
+    """
+
+    with atomic_open(fname) as f:
+        for k in sorted(params.keys()):
+            if k != 'root':
+                f.write(str(k) + ' = ' + str(params[k]) + '\n')
+
+    return fname
+
+
+def morris_trajectory(k, levels):
+    """
+    Return a random Morris trajectory in the unit hypercube
+    with k dimensions and a grid of levels per dimension, as a
+    tuple (points, order, deltas): the k+1 points, the dimension
+    changed at each step and the (signed) size of each step.
+    The step is a whole number of levels (levels/2, rounded
+    down), so that all the points stay on the grid in [0,1].
+    """
+
+    #Work with the indices of the levels, to stay on the grid
+    step = levels//2
+    delta = step/(levels - 1.)
+    idx = [random.randrange(levels) for i in range(k)]
+    order = range(k)
+    random.shuffle(order)
+    points = [np.array(idx)/(levels - 1.)]
+    deltas = []
+    for i in order:
+        if idx[i] + step <= levels - 1:
+            idx[i] += step
+            deltas.append(delta)
+        else:
+            idx[i] -= step
+            deltas.append(-delta)
+        points.append(np.array(idx)/(levels - 1.))
+
+    return (np.array(points), order, deltas)
+
+
+def unit_to_sample(params, u):
+    """
+    Return the sample (dict with the values of the varying
+    parameters) at the point u of the unit hypercube, mapped
+    on the ranges with their priors.
+    """
+
+    u = np.asarray(u, dtype=float)
+    if not np.all((u >= 0.) & (u <= 1.)):
+        raise ValueError('--------> Point outside the unit hypercube!')
+    space = params['space']
+    x = space['lo'] + u*space['width']
+    x[space['log']] = np.exp(x[space['log']])
+
+    return dict(zip(space['names'][:space['n_var']], x.tolist()))
+
+
+def sample_to_unit(params, sample):
+    """
+    Return the coordinates of the sample in the unit
+    hypercube of the priors (inverse of unit_to_sample).
+    """
+
+    space = params['space']
+    x = np.array([float(sample[k]) for k in space['names'][:space['n_var']]])
+    x[space['log']] = np.log(x[space['log']])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = (x - space['lo'])/space['width']
+
+    return np.where(space['width'] == 0., 0.5, u)
+
+
+def fit_runtime_model(params, records):
+    """
+    Fit, for each version of class with at least RUNTIME_MIN_RECORDS
+    runs in the records, a linear model of the log of the runtime in
+    the coordinates of the samples in the unit hypercube. Return a
+    dict with, for each version, the coefficients, the smearing factor
+    (mean of exp(residuals), that corrects the bias of the exponential
+    of the fit), the fraction of runs with output and the number of runs.
+    """
+
+    space = params['space']
+    names = sorted(space['names'][:space['n_var']])
+    model = {}
+    for v in sorted(set(r['v'] for r in records)):
+        rows = [r for r in records if r['v'] == v and r['runtime'] > 0.
+            and sorted(r['sample'].keys()) == names]
+        if len(rows) < gv.RUNTIME_MIN_RECORDS:
+            continue
+        a = np.array([np.append(1., sample_to_unit(params, r['sample']))
+            for r in rows])
+        #Constant model if there are not enough runs for the linear one
+        if len(rows) < 2*a.shape[1]:
+            a = a[:, :1]
+        y = np.log([r['runtime'] for r in rows])
+        coef = np.linalg.lstsq(a, y, rcond=None)[0]
+        model[v] = {
+            'coef': coef,
+            'smearing': np.mean(np.exp(y - a.dot(coef))),
+            'success': np.mean([r['output'] == 1 for r in rows]),
+            'n': len(rows)
+        }
+
+    return model
+
+
+def predict_runtime(params, model, samples, versions):
+    """
+    Return the array with the expected runtime of the versions of
+    class (sum over them) on each sample, or None if there is no
+    model for some of the versions.
+    """
+
+    if [v for v in versions if v not in model]:
+        return None
+    u = np.array([sample_to_unit(params, x) for x in samples])
+    a = np.hstack([np.ones((len(samples), 1)), u])
+    runtime = np.zeros(len(samples))
+    for v in versions:
+        coef = model[v]['coef']
+        runtime += np.exp(a[:, :len(coef)].dot(coef))*model[v]['smearing']
+
+    return runtime
+
+
+def sample_cost(params, model, versions, n_draws=1000):
+    """
+    Return the expected runtime of the versions of class per
+    successful sample, averaged over the priors and divided by
+    the fraction of runs with output, or None if there is no
+    model for some of the versions.
+    """
+
+    if [v for v in versions if v not in model]:
+        return None
+    #Draws in the unit hypercube, independent of the random
+    #state used for the samples
+    u = np.random.RandomState(0).rand(n_draws, params['space']['n_var'])
+    samples = [unit_to_sample(params, x) for x in u]
+    runtime = np.mean(predict_runtime(params, model, samples, versions))
+    #The failures of the versions are assumed to overlap
+    success = min(model[v]['success'] for v in versions)
+
+    return runtime/max(success, 1.e-3)
+
+
+def budget_samples(budget, cost, cores):
+    """
+    Return the largest number of samples that fits in the
+    budget (in node-hours), given the cost per sample in
+    seconds and the number of parallel runs per node.
+    """
+
+    return int(budget*3600.*cores/cost)
+
+
+def print_estimate(n_samples, cost, cores):
+    """
+    Print the estimated node-hours (the wall time on one node)
+    of a sweep of n_samples with cost seconds per sample and
+    cores parallel runs per node.
+    """
+
+    hours = n_samples*cost/cores/3600.
+    print '----> Estimated cost: %.1f s per sample, %.2f node-hours for ' \
+        '%d samples with %d parallel runs per node' \
+        % (cost, hours, n_samples, cores)
+    sys.stdout.flush()
+
+    return
+
+
+def elementary_effects(effects, results, order, deltas):
+    """
+    Append to effects[column][i] the elementary effects of the
+    parameter i along a trajectory, given the results (dicts
+    'file:var:metric' -> diff, None for failed points) at each
+    point. Steps with a failed point are skipped.
+    """
+
+    for (n, (i, delta)) in enumerate(zip(order, deltas)):
+        (y0, y1) = (results[n], results[n+1])
+        if y0 is None or y1 is None:
+            continue
+        for col in y0.keys():
+            if col not in y1 or np.isnan(y0[col]) or np.isnan(y1[col]):
+                continue
+            if col not in effects:
+                effects[col] = [[] for x in order]
+            effects[col][i].append((y1[col] - y0[col])/delta)
+
+    return effects
+
+
+def screen_summary(effects, names, mu_min=gv.SCREEN_MU_MIN):
+    """
+    Return a dict with, for each column, the list of
+    (name, mu*, sigma, number of effects) of each parameter,
+    sorted by decreasing mu* (mean of the absolute elementary
+    effects), and a dict with the score of each parameter,
+    i.e. the max over the columns of mu*/max(mu*). The columns
+    with max(mu*) below mu_min (roundoff) are not scored.
+    """
+
+    summary = {}
+    score = dict((k, 0.) for k in names)
+    for col in sorted(effects.keys()):
+        rows = []
+        for (k, ee) in zip(names, effects[col]):
+            if ee:
+                rows.append((k, np.mean(np.abs(ee)), np.std(ee), len(ee)))
+            else:
+                rows.append((k, np.nan, np.nan, 0))
+        rows.sort(key=lambda x: -x[1] if not np.isnan(x[1]) else np.inf)
+        summary[col] = rows
+        mu_max = np.nanmax([x[1] for x in rows] + [0.])
+        if mu_max > mu_min:
+            for x in rows:
+                if not np.isnan(x[1]):
+                    score[x[0]] = max(score[x[0]], x[1]/mu_max)
+
+    return summary, score
+
+
+def write_screen_file(summary, folders):
+    """
+    Write the ranking of the parameters for each column.
+    """
+
+    fname = folders['main'] + folders['f_prefix'] + 'screen.dat'
+    with atomic_open(fname) as f:
+        f.write('#column    parameter    mu_star    sigma    n_effects\n')
+        for col in sorted(summary.keys()):
+            for (k, mu, sigma, n) in summary[col]:
+                f.write('%s    %s    %10.5e    %10.5e    %d\n'
+                    % (col, k, mu, sigma, n))
+
+    return fname
+
+
+def write_reduced_ini(input_file, fixed, folders):
+    """
+    Copy the input file, replacing the ranges of the
+    parameters in the dict fixed with their values.
+    """
+
+    fname = folders['main'] + folders['f_prefix'] + 'screen.ini'
+    with open(input_file, 'r') as fin:
+        lines = fin.readlines()
+    with atomic_open(fname) as f:
+        for line in lines:
+            key = re.sub('#.+', '', line).split('=')[0].strip()
+            if '=' in line and key in fixed:
+                line = key + ' = ' + repr(fixed[key]) \
+                    + '    #Fixed by screen\n'
+            f.write(line)
+
+    return fname
+
+
+def git_output(repo, *args):
+    """
+    Run a git command in the repository repo
+    and return its output, without the trailing newline.
+    """
+
+    cmd = ['git', '-C', repo] + list(args)
+
+    return subprocess.check_output(cmd).rstrip('\n')
+
+
+def list_commits(repo, good, bad):
+    """
+    Return the list of the commits from good to bad
+    (both included), following the first parents.
+    """
+
+    commits = [git_output(repo, 'rev-parse', good + '^{commit}')]
+    between = git_output(repo, 'rev-list', '--first-parent', '--reverse',
+        good + '..' + bad)
+    commits += [x for x in between.split('\n') if x]
+
+    return commits
+
+
+def extract_commit(repo, commit, path, files=None):
+    """
+    Extract the files (by default all of them)
+    of a commit in the folder path.
+    """
+
+    if files is None:
+        files = []
+
+    archive = subprocess.Popen(['git', '-C', repo, 'archive', commit, '--']
+        + files, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-m', '-C', path],
+        stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise IOError('--------> Unable to extract ' + commit)
+
+    return
+
+
+def build_commit(repo, cache, commit, make_args=''):
+    """
+    Build a commit of (hi_)class in the build cache, where each
+    build is stored in a folder named after the hash of the source
+    tree, so that commits with the same sources are built once.
+    A new build starts from a copy of an existing one, where only
+    the files changed by the commit are updated, so that make can
+    reuse the object files. Return the path of the build, or None
+    if the build failed.
+    """
+
+    tree = git_output(repo, 'rev-parse', commit + '^{tree}')
+    path = cache + tree + '/'
+    lock = cache + tree + '.lock'
+
+    #Wait for concurrent builds of the same tree
+    while True:
+        if os.path.exists(cache + tree + '.built'):
+            return path
+        if os.path.exists(cache + tree + '.failed'):
+            return None
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            time.sleep(gv.QUEUE_POLL)
+
+    try:
+        shutil.rmtree(path, ignore_errors=True)
+        #Start from the most recent existing build, if any
+        built = glob.glob(cache + '*.built')
+        built.sort(key=os.path.getmtime)
+        if built:
+            with open(built[-1], 'r') as f:
+                base = f.read().strip()
+            subprocess.check_call(['cp', '-a', built[-1][:-len('.built')],
+                path[:-1]])
+            changed = git_output(repo, 'diff', '--name-only', '--no-renames',
+                base, commit)
+            changed = [x for x in changed.split('\n') if x]
+            for fname in changed:
+                if os.path.exists(path + fname):
+                    os.remove(path + fname)
+            #The changed files have a new time stamp, so make rebuilds
+            #only their objects (deleted files are not extracted)
+            existing = git_output(repo, 'ls-tree', '-r', '--name-only',
+                commit, '--', *changed)
+            existing = [x for x in existing.split('\n') if x]
+            if existing:
+                extract_commit(repo, commit, path, existing)
+            #Headers and Makefiles are not tracked by make, clean everything
+            if [x for x in changed if not x.endswith('.c')]:
+                subprocess.call(['make', '-C', path, 'clean'])
+            #The objects that store the path of the build are rebuilt
+            for fname in glob.glob(path + '*/*.c'):
+                with open(fname, 'r') as f:
+                    if '__CLASSDIR__' in f.read():
+                        os.utime(fname, None)
+        else:
+            os.makedirs(path)
+            extract_commit(repo, commit, path)
+
+        #Build
+        status = subprocess.call(['make', '-C', path, 'class']
+            + make_args.split())
+        if status == 0 and os.path.exists(path + 'class'):
+            with open(cache + tree + '.built', 'w') as f:
+                f.write(commit + '\n')
+            return path
+        else:
+            open(cache + tree + '.failed', 'w').close()
+            return None
+    finally:
+        os.remove(lock)
+
+
+def run_in_workspace(folders, params, v, sample):
+    """
+    Run the version v of class on a sample (dict with the values
+    of the varying parameters) in a new workspace. Return its
+    output, or None if it did not generate output.
+    """
+
+    ws_folders = dict(folders)
+    ws_folders['tmp'] = create_workspace(folders)
+    try:
+        vector = fill_vector(params['space'], sample,
+            np.zeros(len(params['space']['names'])))
+        root = os.path.relpath(ws_folders['tmp']) + '/' \
+            + folders['f_prefix'] + v + '_'
+        create_sample_ini(params, ws_folders, v, vector, root)
+        run_class(ws_folders, v)
+        if has_output(ws_folders, v, 0):
+            return read_output(ws_folders, v)
+        return None
+    finally:
+        release_workspace(ws_folders['tmp'])
+
+
+def run_build(folders, params, build, samples, pool):
+    """
+    Run the build of class in the folder build on the
+    samples, in parallel with pool. Return the list of
+    outputs (see run_in_workspace).
+    """
+
+    build_folders = dict(folders)
+    build_folders['v1'] = build
+    outputs = pool.map(
+        lambda x: run_in_workspace(build_folders, params, 'v1', x), samples)
+
+    return outputs
+
+
+def max_diff_wrt(params, ref_outputs, outputs):
+    """
+    Return the max over the samples and the variables of the
+    'max' metrics of outputs with respect to ref_outputs
+    (lists of outputs of v1, one per sample). A missing
+    output counts as an infinite diff.
+    """
+
+    max_diff = 0.
+    for (ref, out) in zip(ref_outputs, outputs):
+        if out is None:
+            return np.inf
+        output_data = {'v1': ref, 'v2': out}
+        output_diff = get_output_diff_struct(params, output_data)
+        compare_output(params, output_data, output_diff)
+        for f in output_diff.keys():
+            if 'input_params' in f:
+                continue
+            for k in output_diff[f].keys():
+                if k.endswith(':max') and not np.isnan(output_diff[f][k][-1]):
+                    max_diff = max(max_diff, output_diff[f][k][-1])
 
     return max_diff
 
 
+def get_output_diff_struct(params, output_data):
+    """
+    Return a dictionary with the same structure
+    of output_data[v], with one key 'var:metric'
+    for each dependent variable and metric
+    """
+
+    #Initialize dict
+    output_diff = {}
+
+    #Create input keys
+    output_diff['input_params'] = {}
+    for var in params['var'].keys():
+        output_diff['input_params'][var] = []
+
+    #Create output keys
+    for k in output_data['v1'].keys():
+        output_diff[k] = {}
+        for var in output_data['v1'][k].keys():
+            if var in gv.Y_VARS[file_type(k)]:
+                for metric in get_metrics(params, k):
+                    output_diff[k][var + ':' + metric] = []
+
+
+    return output_diff
+
+
+def compare_output(params, output_data, output_diff, mode='all', x_range=None):
+    """
+    Given the ref output return the dictionary
+    with the metrics (by default the max percentage
+    diff) for each dependent variable. Optionally,
+    x_range is a dict with the (xmin, xmax) range
+    to consider for each file.
+    """
+
+    if x_range is None:
+        x_range = {}
+
+    #Define list of files (generated by both versions)
+    files = [f for f in output_data['v1'].keys() if f in output_data['v2']]
+    #The files generated for the first time in this sample get
+    #nan for the previous ones
+    rows = count_rows(output_diff)
+    for f in files:
+        if f not in output_diff:
+            print '--------> New output file ' + f + '.dat, added to ' \
+                'the output table'
+            output_diff[f] = {}
+            for k in output_data['v1'][f].keys():
+                if k in gv.Y_VARS[file_type(f)]:
+                    for metric in get_metrics(params, f):
+                        output_diff[f][k + ':' + metric] = [np.nan]*rows
+    #The files missing in this sample get nan
+    for f in output_diff.keys():
+        if f != 'input_params' and f not in files:
+            for k in output_diff[f].keys():
+                output_diff[f][k].append(np.nan)
+    #Iterate over the various files
+    for f in files:
+        x = gv.X_VARS[file_type(f)]
+        metrics = get_metrics(params, f)
+        #Define dependent keys for each file
+        keys = output_data['v1'][f].keys()
+        keys = [y for y in keys if y in gv.Y_VARS[file_type(f)]]
+        #If the outputs (and the reference ones, if any) are
+        #identical the diffs are 0, without aligning the curves
+        if mode is 'all' and same_output(output_data, ['v1', 'v2'], f) \
+            and same_output(output_data, ['ref_v1', 'ref_v2'], f):
+            diff = zero_metrics(output_data['v1'][f][x], metrics,
+                xlim=x_range.get(f))
+            for k in keys:
+                for metric in metrics:
+                    output_diff[f][k + ':' + metric].append(diff[metric])
+            continue
+        for k in keys:
+            if mode is 'all':
+                curves = [output_data[v][f][y] for v in ['v1', 'v2']
+                    for y in [x, k]]
+                #Try to subtract the percentage diff of ref,
+                #otherwise the ref differences are not subtracted.
+                try:
+                    ref = [output_data[v][f][y] for v in ['ref_v1', 'ref_v2']
+                        for y in [x, k]]
+                except KeyError:
+                    ref = None
+            elif mode is 'ref':
+                #Try to calculate the percentage diff of ref,
+                #otherwise error.
+                try:
+                    curves = [output_data[v][f][y]
+                        for v in ['ref_v1', 'ref_v2'] for y in [x, k]]
+                except KeyError:
+                    raise IOError('--------> Reference model not found!')
+                ref = None
+
+            #Calculate the metrics
+            diff = diff_metrics(curves, ref, metrics, xlim=x_range.get(f),
+                scale=gv.X_SCALES.get(file_type(f), 'lin'))
+
+            #Assign output values to dict
+            for metric in metrics:
+                output_diff[f][k + ':' + metric].append(diff[metric])
+
+    #Assign input values to dict
+    if params['var']:
+        sample = get_sample(params)
+        for k in params['var'].keys():
+            output_diff['input_params'][k].append(sample[k])
+
+    return output_diff
+
+
+def same_output(output_data, versions, f):
+    """
+    Return True if the file f is identical for the two
+    versions (or if it is missing in both, e.g. when
+    there are no reference models).
+    """
+
+    (v1, v2) = versions
+    if f not in output_data.get(v1, {}) and f not in output_data.get(v2, {}):
+        return True
+    try:
+        (d1, d2) = (output_data[v1][f], output_data[v2][f])
+    except KeyError:
+        return False
+    if d1 is d2:
+        return True
+    if sorted(d1.keys()) != sorted(d2.keys()):
+        return False
+
+    return all(np.array_equal(d1[k], d2[k]) for k in d1.keys())
+
+
+def identical_files(output_data):
+    """
+    Return the list of files with identical output for v1 and v2.
+    """
+
+    return [f for f in output_data['v1'].keys()
+        if f in output_data['v2'] and same_output(output_data, ['v1', 'v2'], f)]
+
+
+def align_curves(curves, ref=None, xlim=None, scale='lin'):
+    """
+    Align two curves, given as a list [x1, y1, x2, y2],
+    on the points of x1 in the overlapping x range.
+    If there is a reference model (with the same structure
+    of curves), subtract its relative diffs.
+    If xlim=(xmin, xmax) restrict the x range.
+    The scale of x is used where the curves have to be
+    interpolated (see sample_curve).
+
+    Return the x points and the relative diffs.
+    """
+
+    (x1, y1, x2, y2) = curves
+
+    #Compute the minimum and maximum values of x
+    xmin = max(np.min(x1), np.min(x2))
+    xmax = min(np.max(x1), np.max(x2))
+    if ref:
+        xmin = max(xmin, np.min(ref[0]), np.min(ref[2]))
+        xmax = min(xmax, np.max(ref[0]), np.max(ref[2]))
+    if xlim:
+        xmin = max(xmin, xlim[0])
+        xmax = min(xmax, xlim[1])
+
+    #Points where the diffs are calculated
+    x = np.asarray(x1)
+    mask = (x >= xmin) & (x <= xmax)
+    x = x[mask]
+
+    #Calculate the relative difference
+    diff = relative_diff(
+        np.asarray(y1)[mask],
+        sample_curve(x, x2, y2, scale)
+        )
+    if ref:
+        diff = diff - relative_diff(
+            sample_curve(x, ref[0], ref[1], scale),
+            sample_curve(x, ref[2], ref[3], scale)
+            )
+
+    return x, diff
+
+
+def sample_curve(x, xp, yp, scale='lin'):
+    """
+    Return the values of the curve (xp, yp) on the points x,
+    inside the range of xp. If all the points of x are in xp
+    (same or nested grids) the values are taken directly.
+    Otherwise the curve is interpolated linearly, in log-log
+    space if scale is 'log' (log-lin if yp is not positive),
+    or as forced by scale = 'loglog' or 'loglin'. The points
+    of x in xp always take the values of yp.
+    """
+
+    xp = np.asarray(xp)
+    yp = np.asarray(yp)
+    #Same grid
+    if len(xp) == len(x) and np.array_equal(xp, x):
+        return yp
+
+    #Sort the curve. The grids of class are monotonic, so usually
+    #they have only to be reversed
+    if len(xp) > 1 and xp[0] > xp[-1]:
+        xp = xp[::-1]
+        yp = yp[::-1]
+    if np.any(xp[1:] < xp[:-1]):
+        order = np.argsort(xp, kind='mergesort')
+        xp = xp[order]
+        yp = yp[order]
+
+    #Nested grids: join on the indices of the points of x in xp
+    idx = np.minimum(np.searchsorted(xp, x), len(xp) - 1)
+    if np.array_equal(xp[idx], x):
+        return yp[idx]
+
+    #Interpolate. For sorted points np.interp starts each search from the
+    #previous interval, so this is a linear-time merge of x and xp
+    if scale == 'log' and np.all(xp > 0.) and np.all(x > 0.):
+        scale = 'loglog' if np.all(yp > 0.) else 'loglin'
+    if scale == 'loglog':
+        y = np.exp(np.interp(np.log(x), np.log(xp), np.log(yp)))
+    elif scale == 'loglin':
+        y = np.interp(np.log(x), np.log(xp), yp)
+    else:
+        y = np.interp(x, xp, yp)
+    #Exact values on the points of xp (exp(log(y)) may differ from y)
+    hit = xp[idx] == x
+    y[hit] = yp[idx][hit]
+
+    return y
+
+
+def relative_diff(y1, y2):
+    """
+    Return y2/y1-1, set to 0 where both y1
+    and y2 vanish, to avoid numerical divergences.
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = y2/y1 - 1.
+    diff[(y1 == 0.) & (y2 == 0.)] = 0.
+
+    return diff
+
+
+def diff_metrics(curves, ref, metrics, xlim=None, scale='lin'):
+    """
+    Align the curves once and return a dict with the
+    value of each metric. Available metrics are:
+    - max: max absolute percentage diff;
+    - rms: root mean square percentage diff;
+    - chi2: cosmic-variance-weighted chi2, sum of
+      (2l+1)/2*diff^2 (meaningful only for Cls).
+    Each of them can be restricted to a window in x,
+    e.g. max[2,30].
+    """
+
+    x, diff = align_curves(curves, ref, xlim, scale)
+
+    acc = init_metrics(metrics)
+    accumulate_metrics(acc, x, diff)
+
+    return metric_values(acc)
+
+
+def zero_metrics(x, metrics, xlim=None):
+    """
+    Return a dict with the value of each metric for
+    identical curves on the points x: 0, or nan if
+    the window of the metric (or xlim) contains no point.
+    """
+
+    x = np.asarray(x)
+    if xlim:
+        x = x[(x >= xlim[0]) & (x <= xlim[1])]
+    acc = init_metrics(metrics)
+    accumulate_metrics(acc, x, np.zeros(len(x)))
+
+    return metric_values(acc)
+
+
+def init_metrics(metrics):
+    """
+    Return a dict with the accumulators of each metric,
+    that can be updated chunk by chunk.
+    """
+
+    return dict((metric, {'max': 0., 'sum': 0., 'n': 0})
+        for metric in metrics)
+
+
+def accumulate_metrics(acc, x, diff):
+    """
+    Update the accumulators of the metrics with
+    the relative diffs diff on the points x.
+    """
+
+    for metric in acc.keys():
+        (name, window) = parse_metric(metric)
+        if window:
+            d = diff[(x >= window[0]) & (x <= window[1])]
+            l = x[(x >= window[0]) & (x <= window[1])]
+        else:
+            d = diff
+            l = x
+        if len(d) == 0:
+            continue
+        acc[metric]['n'] += len(d)
+        if name == 'max':
+            acc[metric]['max'] = np.maximum(acc[metric]['max'],
+                np.max(np.fabs(d)))
+        elif name == 'rms':
+            acc[metric]['sum'] += np.sum(d**2., dtype=np.float64)
+        elif name == 'chi2':
+            acc[metric]['sum'] += np.sum((2.*l+1.)/2.*d**2., dtype=np.float64)
+
+    return acc
+
+
+def metric_values(acc):
+    """
+    Return a dict with the value of each metric
+    from its accumulators (nan if empty).
+    """
+
+    values = {}
+    for metric in acc.keys():
+        name = parse_metric(metric)[0]
+        if acc[metric]['n'] == 0:
+            values[metric] = np.nan
+        elif name == 'max':
+            values[metric] = 100.*float(acc[metric]['max'])
+        elif name == 'rms':
+            values[metric] = 100.*np.sqrt(acc[metric]['sum']/acc[metric]['n'])
+        elif name == 'chi2':
+            values[metric] = acc[metric]['sum']
+
+    return values
+
+
 def write_output_file(output_diff, folders, mode='all'):
     """
-    Write the output table.
+    Write the output table. The columns of the max metric
+    keep the names 'file:var' of the tables written before
+    the metrics were configurable, the other metrics are
+    written as 'file:var:metric'.
     """
 
     array = []
@@ -709,7 +3395,8 @@ def write_output_file(output_diff, folders, mode='all'):
             for var in output_diff[k].keys():
                 col = output_diff[k][var]
                 array.append(col)
-                header = header + str(count) + ':' + k + ':' + var + '    '
+                name = re.sub(':max$', '', k + ':' + var)
+                header = header + str(count) + ':' + name + '    '
                 count = count + 1
 
     #Transpose array
@@ -719,13 +3406,140 @@ def write_output_file(output_diff, folders, mode='all'):
         fname = folders['main'] + folders['f_prefix'] + 'output.dat'
     if mode is 'ref':
         fname = folders['main'] + folders['f_prefix'] + 'ref_output.dat'
+    if mode is 'rediff':
+        fname = folders['main'] + folders['f_prefix'] + 'rediff_output.dat'
+    if mode is 'rediff_ref':
+        fname = folders['main'] + folders['f_prefix'] + 'rediff_ref_output.dat'
 
     #Save file
-    np.savetxt(fname, array, header=header, delimiter='    ', fmt='%10.5e')
+    with atomic_open(fname) as f:
+        np.savetxt(f, array, header=header, delimiter='    ', fmt='%10.5e')
 
     return fname
 
 
+def ladder_summary(output_diff, runtimes, failures, tol):
+    """
+    Summarise the precision ladder. For each candidate
+    store the mean runtime, the number of failures, the
+    worst diff over the samples for each 'file:var:metric'
+    and the number of samples in which each file was
+    missing. The tolerance is a max percentage diff, so
+    the accuracy-versus-cost frontier and the fastest
+    candidate within tolerance are stored only for the
+    max metrics; the others are for information only.
+    """
+
+    summary = {}
+    versions = sorted(output_diff.keys(), key=lambda x: int(x.split('_')[-1]))
+
+    #Names of the variables ('file:var'), of all the candidates
+    summary['vars'] = set()
+    for v in versions:
+        for f in output_diff[v].keys():
+            if 'input_params' not in f:
+                for k in output_diff[v][f].keys():
+                    summary['vars'].add(f + ':' + k)
+    summary['vars'] = sorted(summary['vars'])
+    summary['tol_vars'] = [x for x in summary['vars']
+        if x.rsplit(':', 1)[-1].split('[')[0] == 'max']
+
+    #Runtime and worst diff of each candidate. The files missing
+    #in a sample have nan diffs, which are counted apart
+    summary['baseline_runtime'] = np.mean(runtimes['v1'])
+    summary['runtime'] = {}
+    summary['failures'] = {}
+    summary['diff'] = {}
+    summary['missing'] = {}
+    for v in versions:
+        summary['runtime'][v] = np.mean(runtimes[v])
+        summary['failures'][v] = failures[v]
+        summary['diff'][v] = {}
+        summary['missing'][v] = {}
+        for var in summary['vars']:
+            (f, k) = var.split(':', 1)
+            diff = np.array(output_diff[v].get(f, {}).get(k, []), dtype=float)
+            missing = int(np.isnan(diff).sum())
+            if missing < len(diff):
+                summary['diff'][v][var] = np.nanmax(diff)
+            else:
+                summary['diff'][v][var] = np.nan
+            if missing:
+                summary['missing'][v][f] = missing
+
+    #Frontier and fastest candidate within tolerance. A candidate
+    #is on the frontier if it is more accurate than all the faster ones
+    by_runtime = sorted(versions, key=lambda x: summary['runtime'][x])
+    summary['frontier'] = {}
+    summary['fastest'] = {}
+    for var in summary['tol_vars']:
+        summary['frontier'][var] = []
+        summary['fastest'][var] = None
+        best = np.inf
+        for v in by_runtime:
+            diff = summary['diff'][v][var]
+            if summary['failures'][v] > 0 or np.isnan(diff):
+                continue
+            if diff < best:
+                summary['frontier'][var].append(v)
+                best = diff
+            if diff <= tol and summary['fastest'][var] is None:
+                summary['fastest'][var] = v
+
+    return summary
+
+
+def write_ladder_file(summary, ladder_files, folders, tol):
+    """
+    Write the output table of the precision ladder (all
+    the metrics) and a summary with the frontier and the
+    fastest candidate within tolerance for each max metric.
+    """
+
+    versions = sorted(summary['runtime'].keys(),
+        key=lambda x: int(x.split('_')[-1]))
+
+    #Table with one row per candidate
+    array = []
+    header = '1:candidate    2:runtime    3:speedup    4:failures    '
+    count = 5
+    for var in summary['vars']:
+        header = header + str(count) + ':' + var + '    '
+        count = count + 1
+    for v in versions:
+        row = [int(v.split('_')[-1]), summary['runtime'][v],
+            summary['baseline_runtime']/summary['runtime'][v],
+            summary['failures'][v]]
+        row = row + [summary['diff'][v][var] for var in summary['vars']]
+        array.append(row)
+    fname = folders['main'] + folders['f_prefix'] + 'ladder.dat'
+    with atomic_open(fname) as f:
+        np.savetxt(f, array, header=header, delimiter='    ', fmt='%10.5e')
+
+    #Summary with frontier and fastest candidate
+    fsummary = folders['main'] + folders['f_prefix'] + 'ladder_summary.txt'
+    with atomic_open(fsummary) as f:
+        f.write('#Baseline runtime: %.3f s\n' % summary['baseline_runtime'])
+        f.write('#Tolerance: %.3e %% (max metrics only)\n' % tol)
+        f.write('#Candidates:\n')
+        for v in versions:
+            f.write('#  ' + v.split('_')[-1] + ' = '
+                + ladder_files[int(v.split('_')[-1])-1] + '\n')
+            for k in sorted(summary['missing'][v].keys()):
+                f.write('#    ' + k + ' missing in '
+                    + str(summary['missing'][v][k]) + ' samples\n')
+        for var in summary['tol_vars']:
+            frontier = [x.split('_')[-1] for x in summary['frontier'][var]]
+            fastest = summary['fastest'][var]
+            if fastest:
+                fastest = fastest.split('_')[-1]
+            f.write(var + ':\n')
+            f.write('  frontier = ' + ', '.join(frontier) + '\n')
+            f.write('  fastest within tolerance = ' + str(fastest) + '\n')
+
+    return fname, fsummary
+
+
 def read_output_table(fname):
     """
     Read output file and return a dictionary
@@ -755,7 +3569,7 @@ def read_output_table(fname):
     #Generate dictionary
     for n in range(len(header)):
         prefix = header[n].split(':')[0]
-        if prefix in gv.X_VARS.keys():
+        if file_type(prefix):
             data_plots[header[n]] = table[n]
 
     return data_plots
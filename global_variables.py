@@ -1,25 +1,116 @@
 #This module contains all the constants that the user may want to change,
 #and that are passed through the different modules.
 
-#Independent variables for each file
+#Types of the output files of class. Each file <root><name>.dat is
+#assigned to the first type with a pattern (fnmatch syntax) matching
+#<name>, e.g. P(k) at different redshifts (z1_pk, z2_pk, ...) are all
+#of type 'pk'. The variables and the metrics below are given per type
+FILE_TYPES = [
+    ('background', ['background']),
+    ('thermodynamics', ['thermodynamics']),
+    ('cl', ['cl']),
+    ('cl_lensed', ['cl_lensed']),
+    ('pk', ['pk', 'z*_pk']),
+    ('pk_nl', ['pk_nl', 'z*_pk_nl']),
+    ('tk', ['tk', 'z*_tk'])
+]
+
+#Independent variables for each file type
 X_VARS = {
     'background': 'z',
+    'thermodynamics': 'z',
     'cl': 'l',
-    'pk': 'k'
+    'cl_lensed': 'l',
+    'pk': 'k',
+    'pk_nl': 'k',
+    'tk': 'k'
 }
 
-#Dependent variables for each file
+#Dependent variables for each file type
 Y_VARS = {
     'background': ['H'],
+    'thermodynamics': ['x_e', 'Tb'],
     'cl': ['TT', 'EE'],
-    'pk': ['P']
+    'cl_lensed': ['TT', 'EE'],
+    'pk': ['P'],
+    'pk_nl': ['P'],
+    'tk': ['d_tot', 'phi', 'psi']
+}
+
+#Scale of the independent variable of each file type, used to interpolate
+#the curves of the two versions where their grids differ: 'lin' (linear
+#interpolation) or 'log' (log-log, or log-lin for curves with non-positive
+#values, e.g. transfer functions)
+X_SCALES = {
+    'background': 'lin',
+    'thermodynamics': 'lin',
+    'cl': 'lin',
+    'cl_lensed': 'lin',
+    'pk': 'log',
+    'pk_nl': 'log',
+    'tk': 'log'
+}
+
+#Metrics computed for the dependent variables of each file type. They can
+#be overwritten in the ini file with e.g. "metrics_cl = max, rms, chi2"
+#(for all the files of a type) or "metrics_z2_pk = max" (for one file).
+#Available metrics:
+# - max: max absolute percentage diff
+# - rms: root mean square percentage diff
+# - chi2: cosmic-variance-weighted chi2 (only for Cls)
+#Each metric can be restricted to a window of the independent
+#variable, e.g. "max[2,30]"
+METRICS = {
+    'background': ['max'],
+    'thermodynamics': ['max'],
+    'cl': ['max', 'rms', 'chi2', 'max[2,30]', 'max[30,2500]'],
+    'cl_lensed': ['max', 'rms', 'chi2', 'max[2,30]', 'max[30,2500]'],
+    'pk': ['max', 'max[1e-4,1e-1]', 'max[1e-1,1e1]'],
+    'pk_nl': ['max', 'max[1e-4,1e-1]', 'max[1e-1,1e1]'],
+    'tk': ['max']
 }
 
 #Dictionary between names of variables as written in the class output,
 #and names given internally in this code
 DICTIONARY = {
     'background': {'H [1/Mpc]' : 'H'},
+    'thermodynamics': {'Tb [K]' : 'Tb'},
     'pk': {'k (h/Mpc)' : 'k',
            'P (Mpc/h)^3' : 'P'
-          }
+          },
+    'pk_nl': {'k (h/Mpc)' : 'k',
+              'P (Mpc/h)^3' : 'P'
+             },
+    'tk': {'k (h/Mpc)' : 'k'}
 }
+
+#Maximum number of threads parsing the output files of a run
+READ_THREADS = 8
+
+#Number of rows read at a time by the memory-bounded comparison
+#(run --low-memory)
+CHUNK_ROWS = 10000
+
+#Upper bounds (in seconds) of the buckets of the histograms
+#of the (hi_)class runtimes exposed by the telemetry
+RUNTIME_BUCKETS = [0.5, 1., 2., 5., 10., 20., 30., 60., 120., 300., 600.]
+
+#Time (in seconds) after which the workspace of a job running on
+#another host is considered stale, if its lock has not been updated
+STALE_WORKSPACE = 86400.
+
+#Largest mu* (in the units of the diffs, e.g. percent for max) below
+#which the elementary effects of a variable are considered roundoff,
+#and the variable does not contribute to the screening scores
+SCREEN_MU_MIN = 1.e-8
+
+#Minimum number of runs of a version of class in the runtime log
+#needed to fit its runtime model
+RUNTIME_MIN_RECORDS = 10
+
+#Job queue of the coordinator/worker modes: seconds between two polls
+#of the queue, between two heartbeats of a running job, and without
+#heartbeat after which a job is given back to the queue
+QUEUE_POLL = 1.
+QUEUE_HEARTBEAT = 10.
+QUEUE_TIMEOUT = 60.
@@ -0,0 +1,198 @@
+"""
+Tests of the functions that merge and summarise the diffs.
+Run with: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+import functions as fs
+
+
+nan = np.nan
+
+
+def cl_data(l, amp=1.):
+    """
+    Return the output data of a cl file on the multipoles l.
+    """
+
+    l = np.asarray(l, dtype=float)
+    return {'l': l, 'TT': amp*1.e3/l, 'EE': amp*1.e1/l}
+
+
+class TestMergeOutputDiff(unittest.TestCase):
+
+    def test_new_file_in_later_sample(self):
+        output_diff = {}
+        fs.merge_output_diff(output_diff,
+            {'input_params': {'a': [1.]}, 'cl': {'TT:max': [0.1]}})
+        fs.merge_output_diff(output_diff,
+            {'input_params': {'a': [2.]}, 'cl': {'TT:max': [0.2]},
+            'z2_pk': {'P:max': [0.3]}})
+        self.assertEqual(output_diff['input_params']['a'], [1., 2.])
+        self.assertEqual(output_diff['cl']['TT:max'], [0.1, 0.2])
+        self.assertTrue(np.isnan(output_diff['z2_pk']['P:max'][0]))
+        self.assertEqual(output_diff['z2_pk']['P:max'][1], 0.3)
+
+    def test_missing_file_in_later_sample(self):
+        output_diff = {}
+        fs.merge_output_diff(output_diff,
+            {'input_params': {'a': [1., 2.]}, 'cl': {'TT:max': [0.1, 0.2]},
+            'z2_pk': {'P:max': [0.3, 0.4]}})
+        fs.merge_output_diff(output_diff,
+            {'input_params': {'a': [3.]}, 'cl': {'TT:max': [0.5]}})
+        self.assertEqual(output_diff['cl']['TT:max'], [0.1, 0.2, 0.5])
+        self.assertEqual(len(output_diff['z2_pk']['P:max']), 3)
+        self.assertTrue(np.isnan(output_diff['z2_pk']['P:max'][2]))
+
+
+class TestCompareOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'var': {}, 'metrics': {'cl': ['max', 'max[2,30]']}}
+
+    def compare(self, samples):
+        output_diff = {}
+        for output_data in samples:
+            if not output_diff:
+                output_diff = fs.get_output_diff_struct(self.params,
+                    output_data)
+            fs.compare_output(self.params, output_data, output_diff)
+        return output_diff
+
+    def test_identical(self):
+        data = cl_data(np.arange(2, 100))
+        diff = self.compare([{'v1': {'cl': data}, 'v2': {'cl': data}}])
+        self.assertEqual(diff['cl']['TT:max'], [0.])
+        self.assertEqual(diff['cl']['TT:max[2,30]'], [0.])
+
+    def test_windowed(self):
+        l = np.arange(50, 100)
+        diff = self.compare([{'v1': {'cl': cl_data(l)},
+            'v2': {'cl': cl_data(l, 1.001)}}])
+        self.assertAlmostEqual(diff['cl']['TT:max'][0], 0.1)
+        self.assertTrue(np.isnan(diff['cl']['TT:max[2,30]'][0]))
+
+    def test_identical_empty_window(self):
+        #Empty windows are nan also when the outputs are identical
+        data = cl_data(np.arange(50, 100))
+        diff = self.compare([{'v1': {'cl': data}, 'v2': {'cl': data}}])
+        self.assertEqual(diff['cl']['TT:max'], [0.])
+        self.assertTrue(np.isnan(diff['cl']['TT:max[2,30]'][0]))
+
+    def test_missing_file(self):
+        l = np.arange(2, 100)
+        bg = {'z': np.linspace(0., 1., 10), 'H': np.ones(10)}
+        diff = self.compare([
+            {'v1': {'cl': cl_data(l), 'background': bg},
+            'v2': {'cl': cl_data(l, 1.001), 'background': bg}},
+            {'v1': {'cl': cl_data(l)}, 'v2': {'cl': cl_data(l, 1.001)}}])
+        self.assertEqual(diff['background']['H:max'][0], 0.)
+        self.assertTrue(np.isnan(diff['background']['H:max'][1]))
+        self.assertEqual(len(diff['cl']['TT:max']), 2)
+
+    def test_new_file(self):
+        l = np.arange(2, 100)
+        bg = {'z': np.linspace(0., 1., 10), 'H': np.ones(10)}
+        diff = self.compare([
+            {'v1': {'cl': cl_data(l)}, 'v2': {'cl': cl_data(l)}},
+            {'v1': {'cl': cl_data(l), 'background': bg},
+            'v2': {'cl': cl_data(l), 'background': bg}}])
+        self.assertTrue(np.isnan(diff['background']['H:max'][0]))
+        self.assertEqual(diff['background']['H:max'][1], 0.)
+
+
+class TestScreenSummary(unittest.TestCase):
+
+    def test_roundoff_column(self):
+        #Only roundoff: no parameter is scored
+        effects = {'cl:TT:max': [[1.e-14, -1.e-14], [2.e-15, 1.e-15]]}
+        summary, score = fs.screen_summary(effects, ['a', 'b'])
+        self.assertEqual(score, {'a': 0., 'b': 0.})
+        self.assertEqual(summary['cl:TT:max'][0][0], 'a')
+
+    def test_scores(self):
+        effects = {'cl:TT:max': [[1.e-14, -1.e-14], [2.e-15, 1.e-15]],
+            'pk:P:max': [[0.5, -0.3], [0.02, 0.02]]}
+        summary, score = fs.screen_summary(effects, ['a', 'b'])
+        self.assertEqual(score['a'], 1.)
+        self.assertAlmostEqual(score['b'], 0.05)
+
+    def test_no_effects(self):
+        summary, score = fs.screen_summary({'pk:P:max': [[1.], []]},
+            ['a', 'b'])
+        self.assertEqual(score, {'a': 1., 'b': 0.})
+        self.assertEqual(summary['pk:P:max'][1][3], 0)
+
+
+class TestLadderSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.output_diff = {
+            'v2_1': {'input_params': {},
+                'cl': {'TT:max': [0.2, 0.3], 'TT:chi2': [40., 20.]},
+                'z1_pk': {'P:max': [nan, 0.05]}},
+            'v2_2': {'input_params': {},
+                'cl': {'TT:max': [0.05, 0.01], 'TT:chi2': [0.1, 0.1]},
+                'z1_pk': {'P:max': [0.05, nan]}}}
+        self.runtimes = {'v1': [1., 1.], 'v2_1': [0.2, 0.2],
+            'v2_2': [0.5, 0.5]}
+        self.failures = {'v2_1': 0, 'v2_2': 0}
+
+    def test_missing_files(self):
+        #The max diff does not depend on the order of the nan
+        summary = fs.ladder_summary(self.output_diff, self.runtimes,
+            self.failures, 0.1)
+        self.assertEqual(summary['diff']['v2_1']['z1_pk:P:max'], 0.05)
+        self.assertEqual(summary['diff']['v2_2']['z1_pk:P:max'], 0.05)
+        self.assertEqual(summary['missing']['v2_1'], {'z1_pk': 1})
+        self.assertEqual(summary['missing']['v2_2'], {'z1_pk': 1})
+
+    def test_tolerance_on_max_only(self):
+        summary = fs.ladder_summary(self.output_diff, self.runtimes,
+            self.failures, 0.1)
+        self.assertEqual(summary['tol_vars'], ['cl:TT:max', 'z1_pk:P:max'])
+        self.assertIn('cl:TT:chi2', summary['vars'])
+        self.assertNotIn('cl:TT:chi2', summary['fastest'])
+        self.assertEqual(summary['fastest']['cl:TT:max'], 'v2_2')
+        self.assertEqual(summary['frontier']['cl:TT:max'], ['v2_1', 'v2_2'])
+        self.assertEqual(summary['fastest']['z1_pk:P:max'], 'v2_1')
+
+    def test_failures(self):
+        self.failures['v2_1'] = 1
+        summary = fs.ladder_summary(self.output_diff, self.runtimes,
+            self.failures, 0.1)
+        self.assertEqual(summary['frontier']['cl:TT:max'], ['v2_2'])
+        self.assertEqual(summary['fastest']['z1_pk:P:max'], 'v2_2')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_read_metrics(self):
+        params = {'common': {'metrics_cl': 'max, rms, max[2,30]',
+            'metrics_z2_pk': 'max[1e-4,1e-1]', 'h': '0.7'}}
+        params = fs.read_metrics(params)
+        self.assertEqual(params['common'], {'h': '0.7'})
+        self.assertEqual(params['metrics']['cl'], ['max', 'rms', 'max[2,30]'])
+        self.assertEqual(params['metrics']['z2_pk'], ['max[1e-4,1e-1]'])
+
+    def test_get_metrics(self):
+        params = {'metrics': {'pk': ['rms'], 'z2_pk': ['max']}}
+        self.assertEqual(fs.get_metrics(params, 'z2_pk'), ['max'])
+        self.assertEqual(fs.get_metrics(params, 'z1_pk'), ['rms'])
+        self.assertEqual(fs.get_metrics(params, 'background'),
+            fs.gv.METRICS['background'])
+
+    def test_parse_metric(self):
+        self.assertEqual(fs.parse_metric('max'), ('max', None))
+        self.assertEqual(fs.parse_metric('chi2[2,30]'), ('chi2', (2., 30.)))
+        self.assertRaises(IOError, fs.parse_metric, 'mean')
+
+
+if __name__ == '__main__':
+    unittest.main()